@@ -0,0 +1,459 @@
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+from logic import (grammar, token_category, tokenize, tokenize_ids, parse_Start, parse_arena, process_parse_tree,
+                   text_to_array, Grid, build_events, write_midi, convert_text_to_midi, stream_text_to_midi, MidiFile, MidiTrack)
+
+# Benchmark harness for the conversion pipeline.
+#   python benchmark.py run -o results.json                 time every phase on synthetic inputs
+#   python benchmark.py run --baseline base.json            ...and fail on regressions against a baseline
+#   python benchmark.py compare base.json results.json      compare two saved runs
+#   python benchmark.py startup                             check import and first window times
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+# A section's pitches run from ceil(60 + n / 2) down to ceil(60 + n / 2) - n + 1, which
+# must stay valid MIDI notes
+MAX_SECTION_LENGTH = 123
+DEFAULT_SECTION_LENGTHS = [8, 123]
+DEFAULT_DENSITIES = ['sparse', 'dense']
+DEFAULT_THRESHOLD = 1.25  # current / baseline time above which a phase counts as a regression
+DEFAULT_MEMORY_THRESHOLD = 1.5
+MIN_TIME = 0.2  # keep repeating a phase until it ran for this long (seconds)
+MAX_REPEATS = 50
+# Startup budgets in seconds (median of fresh interpreters, interpreter start included)
+DEFAULT_IMPORT_BUDGET = 0.25
+DEFAULT_WINDOW_BUDGET = 1.0
+STARTUP_REPEATS = 5
+# Runs the GUI with mainloop replaced by drawing the first window once and closing it
+FIRST_WINDOW_SCRIPT = """
+import tkinter
+def show_first_window(window):
+    window.update()
+    window.destroy()
+tkinter.Tk.mainloop = show_first_window
+import main
+"""
+
+# Pattern tokens grouped by the number of filled rows: sparse inputs are mostly silent
+# columns and single notes, dense inputs mostly use four or five notes per column
+patterns_by_notes = {}
+for token, category in token_category.items():
+    value = grammar[category][token]
+    if value != 'newline':
+        patterns_by_notes.setdefault(sum(value), []).append(token)
+density_weights = {
+    'sparse': {0: 6, 1: 3, 2: 1},
+    'dense': {3: 1, 4: 3, 5: 2},
+}
+
+
+def make_text(tokens, section_length, density, seed=0):
+    """
+    Returns a valid input of the given number of pattern tokens, split into sections of
+    section_length patterns by 9p separators.
+    """
+    rng = random.Random(seed)
+    weights = density_weights[density]
+    pool = [token for notes, weight in weights.items() for token in patterns_by_notes[notes] * weight]
+    parts = []
+    for index in range(tokens):
+        if index and index % section_length == 0:
+            parts.append('9p')
+        parts.append(rng.choice(pool))
+    return ''.join(parts)
+
+
+def phase_tokenize(text, state):
+    state['tokens'] = tokenize(text)
+
+
+def phase_parse(text, state):
+    state['parse_tree'] = parse_Start(state['tokens'])
+
+
+def phase_tokenize_ids(text, state):
+    state['token_ids'] = tokenize_ids(text)
+
+
+def phase_parse_arena(text, state):
+    state['parse_arena'] = parse_arena(state['token_ids'])
+
+
+def phase_process_parse_tree(text, state):
+    mid = MidiFile()
+    track = MidiTrack()
+    mid.tracks.append(track)
+    process_parse_tree(state['parse_tree'], track)
+    state['mido_file'] = mid
+
+
+def phase_text_to_array(text, state):
+    text_to_array(text)
+
+
+def phase_build_events(text, state):
+    grid = Grid.from_parse_tree(state['parse_tree'])
+    state['events'] = build_events(grid.masks, grid.section_starts)[:3]
+
+
+def phase_save(text, state):
+    write_midi(*state['events'], os.path.join(state['directory'], 'native.mid'))
+
+
+def phase_save_mido(text, state):
+    state['mido_file'].save(os.path.join(state['directory'], 'mido.mid'))
+
+
+def phase_end_to_end(text, state):
+    convert_text_to_midi(text, os.path.join(state['directory'], 'end_to_end.mid'))
+
+
+def phase_end_to_end_mido(text, state):
+    convert_text_to_midi(text, os.path.join(state['directory'], 'end_to_end_mido.mid'), backend='mido')
+
+
+def phase_stream(text, state):
+    stream_text_to_midi(text.encode('ascii'), BytesIO())
+
+
+# Phases in run order: name -> (function, phases whose state it needs, needs mido)
+phases = {
+    'tokenize': (phase_tokenize, [], False),
+    'parse_Start': (phase_parse, ['tokenize'], False),
+    'tokenize_ids': (phase_tokenize_ids, [], False),
+    'parse_arena': (phase_parse_arena, ['tokenize_ids'], False),
+    'process_parse_tree': (phase_process_parse_tree, ['parse_Start'], True),
+    'text_to_array': (phase_text_to_array, [], False),
+    'build_events': (phase_build_events, ['parse_Start'], False),
+    'save': (phase_save, ['build_events'], False),
+    'save_mido': (phase_save_mido, ['process_parse_tree'], True),
+    'end_to_end': (phase_end_to_end, [], False),
+    'end_to_end_mido': (phase_end_to_end_mido, [], True),
+    'stream': (phase_stream, [], False),
+}
+
+
+def required_phases(selected):
+    """
+    Returns the selected phases plus the ones they depend on, in run order.
+    """
+    needed = set()
+    pending = list(selected)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending += phases[name][1]
+    return [name for name in phases if name in needed]
+
+
+def time_phase(function, text, state):
+    """
+    Runs function until MIN_TIME has passed (at most MAX_REPEATS times) and returns the
+    list of run times in seconds.
+    """
+    runs = []
+    while not runs or (sum(runs) < MIN_TIME and len(runs) < MAX_REPEATS):
+        gc.collect()
+        start = time.perf_counter()
+        function(text, state)
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def peak_memory(function, text, state):
+    """
+    Returns the peak number of bytes allocated by one run of function. Measured in a
+    separate run because tracemalloc slows everything down.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function(text, state)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(tokens, section_length, density, selected, measure_memory=True, logger=print):
+    """
+    Benchmarks the selected phases on one synthetic input and returns a result per phase.
+    """
+    text = make_text(tokens, section_length, density)
+    case = f"{density}-{tokens}-s{section_length}"
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        state = {'directory': directory}
+        for name in required_phases(selected):
+            function, _, needs_mido = phases[name]
+            if needs_mido and MidiFile is None:
+                logger(f"{case} {name}: skipped, mido is not installed")
+                continue
+            runs = time_phase(function, text, state)
+            if name not in selected:
+                continue
+            best = min(runs)
+            result = {
+                'case': case,
+                'phase': name,
+                'tokens': tokens,
+                'section_length': section_length,
+                'density': density,
+                'input_bytes': len(text),
+                'runs': len(runs),
+                'seconds_min': best,
+                'seconds_median': statistics.median(runs),
+                'tokens_per_second': tokens / best if best > 0 else None,
+                'peak_bytes': peak_memory(function, text, state) if measure_memory else None,
+            }
+            results.append(result)
+            logger(f"{case} {name}: {best * 1000:.3f} ms, " + (
+                f"{result['peak_bytes'] / 1024:,.0f} KiB peak" if measure_memory else "memory not measured"))
+    return results
+
+
+def scaling_report(results):
+    """
+    Fits time ~ tokens ** exponent per phase, density and section length over the inputs
+    of at least 1000 tokens. A linear phase has an exponent close to 1.
+    """
+    groups = {}
+    for result in results:
+        if result['tokens'] >= 1000:
+            key = (result['phase'], result['density'], result['section_length'])
+            groups.setdefault(key, []).append(result)
+    report = []
+    for (phase, density, section_length), group in groups.items():
+        if len(group) < 2:
+            continue
+        xs = [math.log(result['tokens']) for result in group]
+        ys = [math.log(max(result['seconds_min'], 1e-9)) for result in group]
+        x_mean = statistics.fmean(xs)
+        y_mean = statistics.fmean(ys)
+        slope = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum((x - x_mean) ** 2 for x in xs)
+        largest = max(group, key=lambda result: result['tokens'])
+        report.append({
+            'phase': phase,
+            'density': density,
+            'section_length': section_length,
+            'exponent': slope,
+            'largest_tokens': largest['tokens'],
+            'tokens_per_second': largest['tokens_per_second'],
+        })
+    return report
+
+
+def environment():
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': numpy_version,
+        'mido': MidiFile is not None,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def run_benchmarks(sizes=None, section_lengths=None, densities=None, selected=None, measure_memory=True,
+                   logger=print):
+    """
+    Runs every combination of input size, section length and density and returns the
+    results in the JSON layout written by 'python benchmark.py run'.
+    """
+    results = []
+    for density in densities or DEFAULT_DENSITIES:
+        for section_length in section_lengths or DEFAULT_SECTION_LENGTHS:
+            for tokens in sizes or DEFAULT_SIZES:
+                results += run_case(tokens, section_length, density, selected or list(phases), measure_memory,
+                                    logger)
+    return {'environment': environment(), 'results': results, 'scaling': scaling_report(results)}
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, memory_threshold=DEFAULT_MEMORY_THRESHOLD):
+    """
+    Compares two benchmark runs phase by phase. Returns a list of comparisons, each with
+    a 'regression' flag set when the time or peak memory ratio exceeds its threshold.
+    """
+    baseline_results = {(result['case'], result['phase']): result for result in baseline['results']}
+    comparisons = []
+    for result in current['results']:
+        old = baseline_results.get((result['case'], result['phase']))
+        if old is None:
+            continue
+        time_ratio = result['seconds_min'] / old['seconds_min'] if old['seconds_min'] > 0 else None
+        memory_ratio = None
+        if result['peak_bytes'] is not None and old['peak_bytes']:
+            memory_ratio = result['peak_bytes'] / old['peak_bytes']
+        comparisons.append({
+            'case': result['case'],
+            'phase': result['phase'],
+            'baseline_seconds': old['seconds_min'],
+            'seconds': result['seconds_min'],
+            'time_ratio': time_ratio,
+            'memory_ratio': memory_ratio,
+            'regression': (time_ratio is not None and time_ratio > threshold)
+                          or (memory_ratio is not None and memory_ratio > memory_threshold),
+        })
+    return comparisons
+
+
+def print_scaling(report):
+    print("Scaling (time ~ tokens ** exponent):")
+    for entry in report:
+        speed = entry['tokens_per_second']
+        print(f"  {entry['phase']:<20} {entry['density']:<6} s{entry['section_length']:<4} "
+              f"exponent {entry['exponent']:.2f}, " + (f"{speed:,.0f} tokens/s" if speed else "n/a")
+              + f" at {entry['largest_tokens']:,} tokens")
+
+
+def print_comparisons(comparisons):
+    regressions = 0
+    for entry in comparisons:
+        memory = f", memory x{entry['memory_ratio']:.2f}" if entry['memory_ratio'] is not None else ""
+        time_ratio = f"x{entry['time_ratio']:.2f}" if entry['time_ratio'] is not None else "n/a"
+        line = f"{entry['case']} {entry['phase']}: {time_ratio}{memory}"
+        if entry['regression']:
+            regressions += 1
+            print(f"\033[91m{line} REGRESSION\033[0m")  # Print regressions in red text
+        else:
+            print(line)
+    print(f"{regressions} regressions in {len(comparisons)} comparisons.")
+    return regressions
+
+
+def time_startup(code, repeats=STARTUP_REPEATS):
+    """
+    Runs code in fresh interpreters from this directory after one warm-up run. Returns the
+    wall times in seconds and None, or None and the error when the code fails.
+    """
+    times = []
+    for run in range(repeats + 1):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if result.returncode:
+            lines = result.stderr.strip().splitlines()
+            return None, lines[-1] if lines else f"exit status {result.returncode}"
+        if run:
+            times.append(elapsed)
+    return times, None
+
+
+def run_startup(import_budget=DEFAULT_IMPORT_BUDGET, window_budget=DEFAULT_WINDOW_BUDGET, repeats=STARTUP_REPEATS,
+                logger=print):
+    """
+    Times starting a bare interpreter, importing logic and showing the first GUI window.
+    Returns a result per check with an 'over_budget' flag; the window check is skipped
+    (error set) when Tk cannot open a display.
+    """
+    checks = [
+        ('interpreter', 'pass', None),
+        ('import logic', 'import logic', import_budget),
+        ('first window', FIRST_WINDOW_SCRIPT, window_budget),
+    ]
+    results = []
+    for name, code, budget in checks:
+        times, error = time_startup(code, repeats)
+        result = {'check': name, 'budget': budget, 'error': error, 'seconds_min': None, 'seconds_median': None,
+                  'over_budget': False}
+        if times:
+            result['seconds_min'] = min(times)
+            result['seconds_median'] = statistics.median(times)
+            result['over_budget'] = budget is not None and result['seconds_median'] > budget
+        results.append(result)
+        if error:
+            logger(f"{name}: skipped, {error}")
+        else:
+            line = f"{name}: {result['seconds_median'] * 1000:.1f} ms median, {result['seconds_min'] * 1000:.1f} ms min"
+            if budget is not None:
+                line += f" (budget {budget * 1000:.0f} ms)"
+            logger(f"\033[91m{line} OVER BUDGET\033[0m" if result['over_budget'] else line)
+    return {'environment': environment(), 'startup': results}
+
+
+def parse_list(value, convert=str):
+    return [convert(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python benchmark.py', description="Benchmarks for the text to MIDI converter")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="benchmark the pipeline on synthetic inputs")
+    run.add_argument('-o', '--output', default='benchmark_results.json')
+    run.add_argument('--sizes', type=lambda value: parse_list(value, int), default=DEFAULT_SIZES,
+                     help="comma separated pattern token counts")
+    run.add_argument('--section-lengths', type=lambda value: parse_list(value, int), default=DEFAULT_SECTION_LENGTHS,
+                     help="comma separated patterns per section")
+    run.add_argument('--densities', type=parse_list, default=DEFAULT_DENSITIES, help="sparse and/or dense")
+    run.add_argument('--phases', type=parse_list, default=list(phases), help=f"any of {', '.join(phases)}")
+    run.add_argument('--no-memory', action='store_true', help="skip the tracemalloc peak memory runs")
+    run.add_argument('--baseline', default=None, help="results JSON to check this run against")
+    run.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    run.add_argument('--memory-threshold', type=float, default=DEFAULT_MEMORY_THRESHOLD)
+
+    check = commands.add_parser('compare', help="compare two saved benchmark runs")
+    check.add_argument('baseline')
+    check.add_argument('current')
+    check.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    check.add_argument('--memory-threshold', type=float, default=DEFAULT_MEMORY_THRESHOLD)
+
+    startup = commands.add_parser('startup', help="check import and first window times against budgets")
+    startup.add_argument('-o', '--output', default=None, help="also write the results as JSON")
+    startup.add_argument('--import-budget', type=float, default=DEFAULT_IMPORT_BUDGET, help="seconds")
+    startup.add_argument('--window-budget', type=float, default=DEFAULT_WINDOW_BUDGET, help="seconds")
+    startup.add_argument('--repeats', type=int, default=STARTUP_REPEATS)
+
+    args = parser.parse_args(argv)
+    if args.command == 'startup':
+        report = run_startup(args.import_budget, args.window_budget, args.repeats)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        return 1 if any(result['over_budget'] for result in report['startup']) else 0
+    if args.command == 'run':
+        unknown = [name for name in args.phases if name not in phases]
+        if unknown or any(density not in density_weights for density in args.densities):
+            parser.error(f"unknown phase or density: {', '.join(unknown or args.densities)}")
+        if any(length < 1 or length > MAX_SECTION_LENGTH for length in args.section_lengths):
+            parser.error(f"section lengths must be between 1 and {MAX_SECTION_LENGTH}")
+        current = run_benchmarks(args.sizes, args.section_lengths, args.densities, args.phases, not args.no_memory)
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+        print_scaling(current['scaling'])
+        print(f"Results written to '{args.output}'.")
+        if args.baseline is None:
+            return 0
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+    comparisons = compare(baseline, current, args.threshold, args.memory_threshold)
+    return 1 if print_comparisons(comparisons) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,51 @@
+import argparse
+import hashlib
+import importlib
 import math
 import json
-from mido import MidiFile, MidiTrack, Message
+import mmap
+import os
+import pickle
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, suppress
+from itertools import accumulate, groupby, repeat
+
+# Optional dependencies are imported on first use instead of with this module, which keeps
+# starting the GUI, the CLI and pool workers quick. mido is only needed for the 'mido'
+# backend and process_parse_tree, NumPy speeds up the event builder and the image encoder
+# and Pillow reads image formats other than PBM, PGM and grayscale PNG.
+optional_modules = {}  # module name -> module, None when it is not installed
+
+
+def optional_import(name):
+    """
+    Imports an optional dependency the first time it is needed. Returns None when it is
+    not installed.
+    """
+    if name not in optional_modules:
+        try:
+            optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            optional_modules[name] = None
+    return optional_modules[name]
+
+
+def __getattr__(name):
+    # MidiFile, MidiTrack and Message can still be imported from here (None without mido)
+    if name in ('MidiFile', 'MidiTrack', 'Message'):
+        mido = optional_import('mido')
+        return None if mido is None else getattr(mido, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 grammar = {
     'Start': [['Pattern', 'Sequence']],
@@ -69,176 +114,1912 @@ def get_keys(dictionary):
     return [k for k in dictionary.keys()]
 
 
-token_list = []
-token_max_length = 2
-for item in grammar.values():
-    if isinstance(item, dict):
-        token_list += get_keys(item)
+# The token tables (token_names, token_ids, token_lookup, token_category, parse_table)
+# are compiled from the grammar further down, see load_grammar_tables
 
 
-def tokenize(text):
-    global token_list, token_max_length
-    tokens = []
-    start = 0
-    end = 1
-    while end <= len(text):
-        token = text[start:end]
-        if len(token) > token_max_length:
-            raise ValueError("Failed to tokenize")
-        if token in token_list:
-            tokens.append(token)
-            start = end
-        end += 1
-    if end - start > 1:
-        raise ValueError("Failed to tokenize")
-    return tokens
-
-
-def parse_rule(rule_name, tokens, index):
-    print(f"Parsing rule: {rule_name}, Tokens: {tokens[index:]}, Index: {index}")
-
-    # Check if the rule exists in the grammar
-    if rule_name not in grammar:
-        raise KeyError(f"Grammar rule '{rule_name}' not found.")
-
-    rule_def = grammar[rule_name]
-
-    if isinstance(rule_def, dict):
-        # Terminal symbol
-        if index < len(tokens) and tokens[index] in rule_def:
-            token_value = rule_def[tokens[index]]
-            print(f"Matched terminal: {tokens[index]} to rule: {rule_name}")
-            return {'type': rule_name, 'token': tokens[index], 'value': token_value, 'index': index + 1}
-        else:
-            print(f"Failed to match terminal: {tokens[index] if index < len(tokens) else 'EOF'} to rule: {rule_name}")
+# Trace levels: phases logs one line per pipeline phase, symbols logs every parser step
+TRACE_OFF = 0
+TRACE_PHASES = 1
+TRACE_SYMBOLS = 2
+
+trace_hook = None
+trace_level = TRACE_OFF
+
+
+def set_trace(hook=print, level=TRACE_PHASES):
+    """
+    Installs a trace hook called with one message string per trace event.
+    Passing level=TRACE_OFF (or hook=None) disables tracing, which costs one
+    flag check per parser step.
+    """
+    global trace_hook, trace_level
+    if hook is None or level <= TRACE_OFF:
+        trace_hook, trace_level = None, TRACE_OFF
+    else:
+        trace_hook, trace_level = hook, level
+
+
+class PipelineStats:
+    """
+    Timings (seconds) and counters collected while converting one input.
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+            if trace_level >= TRACE_PHASES:
+                trace_hook(f"[{name}] {elapsed * 1000:.3f} ms")
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def rate(self, counter, phase):
+        """
+        Returns counter per second of the given phase, or None if the phase took no measurable time.
+        """
+        elapsed = self.timings.get(phase, 0.0)
+        if elapsed <= 0:
             return None
-    elif isinstance(rule_def, list):
-        # Non-terminal symbol
+        return self.counters.get(counter, 0) / elapsed
+
+    def as_dict(self):
+        return {'timings': dict(self.timings), 'counters': dict(self.counters)}
+
+    def summary_lines(self):
+        lines = [f"{name}: {elapsed * 1000:.3f} ms" for name, elapsed in self.timings.items()]
+        lines += [f"{name}: {value}" for name, value in self.counters.items()]
+        tokens_per_second = self.rate('tokens', 'tokenize')
+        if tokens_per_second is not None:
+            lines.append(f"tokenize speed: {tokens_per_second:,.0f} tokens/s")
+        tokens_per_second = self.rate('tokens', 'parse')
+        if tokens_per_second is not None:
+            lines.append(f"parse speed: {tokens_per_second:,.0f} tokens/s")
+        return lines
+
+
+class TokenizeError(ValueError):
+    """
+    Raised when the input contains something that is not a token.
+    `offset` is the byte offset of the first invalid token.
+    """
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+    def __reduce__(self):  # keep offset when the error is sent back from a worker process
+        return type(self), (str(self), self.offset)
+
+
+def tokenize_ids(data, offset=0):
+    """
+    Tokenizes a str, bytes or memoryview into an array('B') of token IDs (indexes into token_names).
+    `offset` is the position of data within a larger input and is only used in error offsets.
+    """
+    return default_tables.tokenize_ids(data, offset)
+
+
+def tokenize(text):
+    return list(map(token_names.__getitem__, tokenize_ids(text)))
+
+
+class ParseError(ValueError):
+    """
+    Raised when the token stream does not match the grammar.
+    `offset` is the index of the token where parsing stopped.
+    """
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+    def __reduce__(self):  # keep offset when the error is sent back from a worker process
+        return type(self), (str(self), self.offset)
+
+
+END_OF_INPUT = '$'
+
+
+def compute_first_sets(grammar):
+    """
+    Computes the FIRST set of every rule. Terminal categories are their own FIRST set,
+    an empty string in a set means the rule can derive the empty production.
+    """
+    first = {name: ({name} if isinstance(rule_def, dict) else set()) for name, rule_def in grammar.items()}
+    changed = True
+    while changed:
+        changed = False
+        for name, rule_def in grammar.items():
+            if isinstance(rule_def, dict):
+                continue
+            for production in rule_def:
+                production_first = first_of_sequence(production, first)
+                if not production_first <= first[name]:
+                    first[name] |= production_first
+                    changed = True
+    return first
+
+
+def first_of_sequence(symbols, first):
+    result = set()
+    for symbol in symbols:
+        result |= first[symbol] - {''}
+        if '' not in first[symbol]:
+            return result
+    result.add('')
+    return result
+
+
+def compute_follow_sets(grammar, first, start='Start'):
+    follow = {name: set() for name, rule_def in grammar.items() if isinstance(rule_def, list)}
+    follow[start].add(END_OF_INPUT)
+    changed = True
+    while changed:
+        changed = False
+        for name, rule_def in grammar.items():
+            if isinstance(rule_def, dict):
+                continue
+            for production in rule_def:
+                for i, symbol in enumerate(production):
+                    if symbol not in follow:
+                        continue
+                    rest_first = first_of_sequence(production[i + 1:], first)
+                    new_follow = rest_first - {''}
+                    if '' in rest_first:
+                        new_follow |= follow[name]
+                    if not new_follow <= follow[symbol]:
+                        follow[symbol] |= new_follow
+                        changed = True
+    return follow
+
+
+def build_parse_table(grammar, start='Start'):
+    """
+    Builds the LL(1) parse table: parse_table[rule][terminal category] -> production.
+    Raises ValueError if the grammar is not LL(1).
+    """
+    first = compute_first_sets(grammar)
+    follow = compute_follow_sets(grammar, first, start)
+    table = {}
+    for name, rule_def in grammar.items():
+        if isinstance(rule_def, dict):
+            continue
+        row = table[name] = {}
         for production in rule_def:
-            print(f"Trying production: {production} for rule: {rule_name}")
-            current_index = index
-            parsed_elements = []
+            production_first = first_of_sequence(production, first)
+            lookaheads = production_first - {''}
+            if '' in production_first:
+                lookaheads |= follow[name]
+            for lookahead in lookaheads:
+                if lookahead in row:
+                    raise ValueError(f"Grammar is not LL(1): conflict in rule '{name}' on '{lookahead}'.")
+                row[lookahead] = production
+    return table
 
-            if not production:
-                # Empty production
-                print(f"Matched empty production for rule: {rule_name}")
-                return {'type': rule_name, 'elements': [], 'index': current_index}
 
-            for symbol in production:
-                print(f"Processing symbol: {symbol}")
+# Grammar compiler: a grammar definition is turned into dense tables once (token IDs,
+# the terminal category and row mask of every token, a 65536 entry table mapping every
+# 16-bit word of the input to a token ID, and the LL(1) parse table). The tables are
+# cached on disk next to the bytecode, keyed by a hash of the grammar.
+GRAMMAR_TABLES_VERSION = 1
+NEWLINE_MASK = 255  # mask byte of newline tokens in the compact grid
+grammar_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
 
-                result = parse_rule(symbol, tokens, current_index)
-                if result is None:
-                    print(f"Failed to match symbol: {symbol}, Tokens: {tokens[current_index:]}, Index: {current_index}")
-                    break
-                parsed_elements.append(result)
-                current_index = result['index']
+
+class CompiledGrammar:
+    """
+    Lookup tables compiled from a grammar definition by compile_grammar. Patterns can have
+    any number of rows: a column is pattern_width consecutive pattern tokens of token_rows
+    rows each, lowest rows first, and column masks are ints with bit i set when row i is filled.
+    """
+    def __init__(self, tables):
+        self.tables = tables
+        self.start = tables['start']
+        self.token_names = tables['token_names']  # token ID -> token
+        self.token_categories = tables['token_categories']  # token ID -> terminal category
+        self.token_masks = tables['token_masks']  # token ID -> row mask, None for newline tokens
+        self.token_length = tables['token_length']
+        self.token_rows = tables['token_rows']
+        self.pattern_width = tables['pattern_width']
+        self.row_count = self.token_rows * self.pattern_width
+        self.id_type = tables['id_type']
+        self.invalid_token = tables['invalid_token']
+        self.token_lookup = tables['token_lookup']  # None unless tokens are 2 characters
+        self.parse_table = tables['parse_table']
+        self.terminals = set(tables['terminals'])
+        self.token_ids = {token: token_id for token_id, token in enumerate(self.token_names)}
+        self.token_category = dict(zip(self.token_names, self.token_categories))
+        # token ID -> mask for bytes.translate when every column fits in a mask byte below
+        # NEWLINE_MASK, which is what the compact Grid needs; None for wider grammars
+        self.mask_table = None
+        if self.pattern_width == 1 and self.row_count < 8 and self.id_type == 'B':
+            masks = (NEWLINE_MASK if mask is None else mask for mask in self.token_masks)
+            self.mask_table = bytes(masks).ljust(256, b'\0')
+
+    def tokenize_ids(self, data, offset=0):
+        """
+        Tokenizes a str, bytes or memoryview into an array of token IDs (indexes into token_names).
+        `offset` is the position of data within a larger input and is only used in error offsets.
+        """
+        length = self.token_length
+        if isinstance(data, str):
+            try:
+                data = data.encode('ascii')
+            except UnicodeEncodeError as e:
+                position = offset + e.start - e.start % length
+                raise TokenizeError(f"Failed to tokenize: invalid token at byte {position}.", position)
+        view = memoryview(data).cast('B')
+        if len(view) % length:
+            position = offset + len(view) - len(view) % length
+            raise TokenizeError(f"Failed to tokenize: incomplete token at byte {position}.", position)
+
+        if self.token_lookup is None:
+            get = self.token_ids.get
+            data = bytes(view).decode('latin-1')
+            ids = array(self.id_type, [get(data[i:i + length], self.invalid_token) for i in range(0, len(data), length)])
+        elif self.id_type == 'B':
+            ids = array('B', bytes(map(self.token_lookup.__getitem__, view.cast('H'))))
+        else:
+            ids = array(self.id_type, map(self.token_lookup.__getitem__, view.cast('H')))
+        if self.invalid_token in ids:
+            local = ids.index(self.invalid_token) * length
+            found = bytes(view[local:local + length]).decode('ascii', 'replace')
+            position = offset + local
+            raise TokenizeError(f"Failed to tokenize: invalid token '{found}' at byte {position}.", position)
+        return ids
+
+    def advance(self, stack, token, index):
+        """
+        Feeds one token (None at the end of input) to an LL(1) parser stack without building
+        a tree, so input can be validated as it streams in. Start with stack = [self.start].
+        """
+        lookahead = END_OF_INPUT if token is None else self.token_category.get(token)
+        while stack:
+            symbol = stack.pop()
+            if symbol in self.terminals:
+                if symbol != lookahead:
+                    raise_parse_error(symbol, token, index)
+                return
+            production = self.parse_table[symbol].get(lookahead)
+            if production is None:
+                raise_parse_error(symbol, token, index)
+            stack.extend(reversed(production))
+        if token is not None:
+            raise_parse_error(self.start, token, index)
+
+    def check_ids(self, ids):
+        """
+        Runs token IDs through the LL(1) parse table without building a tree and raises
+        ParseError at the first token that does not fit the grammar.
+        """
+        stack = [self.start]
+        advance, names = self.advance, self.token_names
+        for index, token_id in enumerate(ids):
+            advance(stack, names[token_id], index)
+        advance(stack, None, len(ids))
+
+    def sections(self, ids):
+        """
+        Returns the column masks of every section of already checked token IDs, as Grid
+        sections when the grammar fits the compact grid and as lists of ints otherwise.
+        """
+        if self.mask_table is not None:
+            return list(Grid.from_token_ids(ids, self).sections())
+        sections = [[]]
+        masks = self.token_masks
+        column = filled = 0
+        for token_id in ids:
+            mask = masks[token_id]
+            if mask is None:
+                sections.append([])
+                continue
+            column |= mask << (self.token_rows * filled)
+            filled += 1
+            if filled == self.pattern_width:
+                sections[-1].append(column)
+                column = filled = 0
+        return sections
+
+    def parse_sections(self, text):
+        ids = self.tokenize_ids(text)
+        self.check_ids(ids)
+        return self.sections(ids)
+
+    def text_to_array(self, text):
+        """
+        Returns the grid in the text_to_array format: row_count lists of 0/1 per section.
+        """
+        rows = []
+        for section in self.parse_sections(text):
+            rows += section_rows(section, self.row_count)
+        return rows
+
+    def build_events(self, sections, total_skips=0):
+        statuses, notes, times = [], [], []
+        for section in sections:
+            total_skips = build_section_events(section, total_skips, statuses, notes, times, self.row_count)
+        return statuses, notes, times, total_skips
+
+    def text_to_midi(self, text, dst=None):
+        """
+        Converts text to a MIDI file like the native backend of text_to_midi2, every row
+        of a section being one time step. dst works like in write_midi.
+        """
+        statuses, notes, times, _ = self.build_events(self.parse_sections(text))
+        return write_midi(statuses, notes, times, dst)
+
+
+def pattern_to_mask(pattern):
+    return sum(value << row for row, value in enumerate(pattern))
+
+
+def compile_grammar(grammar, start='Start'):
+    """
+    Compiles a grammar definition into a CompiledGrammar. Terminal categories map tokens
+    to a list of rows or to 'newline'; every token must have the same number of ASCII
+    characters, every pattern the same number of rows and every column the same number
+    of pattern tokens. Raises ValueError otherwise.
+    """
+    parse_table = build_parse_table(grammar, start)
+    terminals = [name for name, rule_def in grammar.items() if isinstance(rule_def, dict)]
+    token_names, token_categories, token_masks = [], [], []
+    for name in terminals:
+        for token, value in grammar[name].items():
+            token_names.append(token)
+            token_categories.append(name)
+            token_masks.append(None if value == 'newline' else pattern_to_mask(value))
+
+    if len(set(token_names)) != len(token_names):
+        raise ValueError("Every token must belong to a single terminal category.")
+    token_length = len(token_names[0]) if token_names else 0
+    if not token_length or any(len(token) != token_length or not token.isascii() for token in token_names):
+        raise ValueError("Every token must have the same number of ASCII characters.")
+    pattern_terminals = {name for name in terminals if any(value != 'newline' for value in grammar[name].values())}
+    token_rows = {len(value) for name in pattern_terminals for value in grammar[name].values()}
+    if len(token_rows) != 1:
+        raise ValueError("Every pattern must have the same number of rows.")
+    pattern_widths = {
+        len(production)
+        for rule_def in grammar.values() if isinstance(rule_def, list)
+        for production in rule_def if production and all(symbol in pattern_terminals for symbol in production)
+    }
+    if len(pattern_widths) != 1:
+        raise ValueError("Every column must be made of the same number of pattern tokens.")
+
+    # Token IDs are bytes when they fit, the largest ID value marks an invalid token
+    id_type = 'B' if len(token_names) < 0xff else 'H'
+    if len(token_names) >= 0xffff:
+        raise ValueError("A grammar can have at most 65534 tokens.")
+    invalid_token = 0xff if id_type == 'B' else 0xffff
+    token_lookup = None
+    if token_length == 2:
+        token_lookup = array(id_type, [invalid_token]) * 65536
+        for token_id, token in enumerate(token_names):
+            token_lookup[int.from_bytes(token.encode('ascii'), sys.byteorder)] = token_id
+        if id_type == 'B':
+            token_lookup = token_lookup.tobytes()
+
+    return CompiledGrammar({
+        'start': start,
+        'token_names': token_names,
+        'token_categories': token_categories,
+        'token_masks': token_masks,
+        'token_length': token_length,
+        'token_rows': token_rows.pop(),
+        'pattern_width': pattern_widths.pop(),
+        'id_type': id_type,
+        'invalid_token': invalid_token,
+        'token_lookup': token_lookup,
+        'parse_table': parse_table,
+        'terminals': terminals,
+    })
+
+
+def load_grammar_tables(grammar, start='Start', cache_dir=grammar_cache_dir):
+    """
+    Returns the CompiledGrammar of grammar, loading it from cache_dir when it was compiled
+    before and storing it there otherwise. Pass cache_dir=None to always compile.
+    """
+    if not cache_dir:
+        return compile_grammar(grammar, start)
+    # The lookup table is indexed by native 16-bit words, so the byte order is part of the key
+    definition = json.dumps([GRAMMAR_TABLES_VERSION, sys.byteorder, start, grammar])
+    path = os.path.join(cache_dir, f"grammar-{hashlib.sha256(definition.encode()).hexdigest()[:32]}.pickle")
+    try:
+        with open(path, 'rb') as f:
+            return CompiledGrammar(pickle.load(f))
+    except (OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+        pass
+    compiled = compile_grammar(grammar, start)
+    with suppress(OSError):  # a read-only install just compiles on every import
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(compiled.tables, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+    return compiled
+
+
+def row_grammar(rows):
+    """
+    Generates a grammar for patterns of the given number of rows (8, 16, 88, ...). Up to 8
+    rows a column is one token, the two lowercase hex digits of its mask (bit i is row i);
+    wider columns are written as rows / 8 such tokens, lowest rows first. 9p separates
+    sections like in the default grammar.
+    """
+    if rows < 1 or (rows > 8 and rows % 8):
+        raise ValueError("Patterns wider than 8 rows must have a multiple of 8 rows.")
+    band_rows = min(rows, 8)
+    return {
+        'Start': [['Pattern', 'Sequence']],
+        'Sequence': [
+            ['NewColumn', 'Pattern', 'Sequence'],
+            ['Pattern', 'Sequence'],
+            []
+        ],
+        'Pattern': [['Band'] * (rows // band_rows)],
+        'Band': {f"{mask:02x}": [(mask >> row) & 1 for row in range(band_rows)] for mask in range(1 << band_rows)},
+        'NewColumn': {
+            '9p': 'newline',
+        },
+    }
+
+
+default_tables = load_grammar_tables(grammar)
+if default_tables.token_length != 2 or default_tables.id_type != 'B':
+    raise ValueError("Every token of the default grammar must be 2 ASCII characters, at most 254 tokens.")
+token_names = default_tables.token_names
+token_list = list(token_names)
+token_max_length = default_tables.token_length
+token_ids = default_tables.token_ids
+token_lookup = default_tables.token_lookup
+INVALID_TOKEN = default_tables.invalid_token
+# Map every token to the terminal category (SingleNote, NewColumn, ...) it belongs to
+token_category = default_tables.token_category
+parse_table = default_tables.parse_table
+
+
+def parse_tokens(tokens, start='Start', stats=None):
+    """
+    Table-driven LL(1) parser. Builds the same tree of dicts as the old recursive parser,
+    through parse_arena, so the input length is not limited by the recursion limit.
+    """
+    ids = array('B', (token_ids.get(token, INVALID_TOKEN) for token in tokens))
+    if INVALID_TOKEN in ids:
+        # A string that is not a token fails wherever the parser has got to by then
+        stack = [start]
+        for index, token in enumerate(tokens[:ids.index(INVALID_TOKEN) + 1]):
+            advance_parser(stack, token, index)
+    return parse_arena(ids, start, stats).to_dict()
+
+
+def raise_parse_error(rule_name, token, index):
+    found = 'EOF' if token is None else f"'{token}'"
+    raise ParseError(
+        f"Error: Unable to parse the input text according to the grammar: "
+        f"unexpected {found} at token {index} while parsing {rule_name}.",
+        index
+    )
+
+
+def advance_parser(stack, token, index):
+    """
+    Feeds one token (None at the end of input) to an LL(1) parser stack of the default
+    grammar, see CompiledGrammar.advance.
+    """
+    default_tables.advance(stack, token, index)
+
+
+def parse_Start(tokens, stats=None):
+    return parse_tokens(tokens, 'Start', stats)
+
+
+def iter_tokens(parse_tree):
+    """
+    Yields the token of every terminal in the tree in order.
+    Walks the tree with an explicit stack instead of recursion; a ParseArena is scanned linearly.
+    """
+    if isinstance(parse_tree, ParseArena):
+        yield from map(token_names.__getitem__, parse_tree.token_ids())
+        return
+    stack = [parse_tree]
+    while stack:
+        node = stack.pop()
+        if 'token' in node:
+            yield node['token']
+        elif 'elements' in node:
+            stack.extend(reversed(node['elements']))
+
+
+# Compact parse trees: a ParseArena holds the nodes of a tree in preorder as parallel
+# arrays instead of one dict per node. Symbols are interned as indexes into symbol_names
+# and a node's subtree is the span [node, ends[node]), so its first child is node + 1 and
+# every next child starts where the previous one's subtree ends.
+symbol_names = list(grammar)  # symbol ID -> rule name
+symbol_ids = {name: symbol_id for symbol_id, name in enumerate(symbol_names)}
+NO_TOKEN = INVALID_TOKEN  # token ID of rule (non-terminal) nodes
+END_SYMBOL = len(symbol_names)  # lookahead ID at the end of input
+symbol_is_terminal = [isinstance(grammar[name], dict) for name in symbol_names]
+# token ID -> symbol ID of its terminal category
+token_symbols = [symbol_ids[category] for category in default_tables.token_categories]
+# arena_parse_table[symbol ID][lookahead ID] -> production as symbol IDs, reversed for the stack
+arena_parse_table = [
+    {END_SYMBOL if lookahead == END_OF_INPUT else symbol_ids[lookahead]:
+        tuple(symbol_ids[child] for child in reversed(production))
+     for lookahead, production in parse_table.get(name, {}).items()}
+    for name in symbol_names
+]
+
+
+class ParseArena:
+    """
+    A parse tree as parallel arrays in preorder: the symbol ID, token ID (NO_TOKEN for
+    rules), 'index' and subtree end of every node. Node 0 is the root. index_type is the
+    array type code of indexes and ends.
+    """
+    def __init__(self, index_type='Q'):
+        self.types = array('B')
+        self.tokens = array('B')
+        self.indexes = array(index_type)
+        self.ends = array(index_type)
+
+    def __len__(self):
+        return len(self.types)
+
+    def nbytes(self):
+        return sum(len(a) * a.itemsize for a in (self.types, self.tokens, self.indexes, self.ends))
+
+    def children(self, node):
+        child, end = node + 1, self.ends[node]
+        while child < end:
+            yield child
+            child = self.ends[child]
+
+    def token_ids(self):
+        """
+        The token IDs of all terminals in order, one linear scan of the token array.
+        """
+        return array('B', self.tokens.tobytes().replace(bytes((NO_TOKEN,)), b''))
+
+    def parents(self):
+        """
+        Yields the parent of every node in preorder, -1 for the root.
+        """
+        open_nodes = []  # nodes whose subtree contains the current node
+        ends = self.ends
+        for node in range(len(self.types)):
+            while open_nodes and ends[open_nodes[-1]] <= node:
+                open_nodes.pop()
+            yield open_nodes[-1] if open_nodes else -1
+            open_nodes.append(node)
+
+    def to_dict(self):
+        """
+        Converts the arena to the nested dict tree parse_tokens builds.
+        """
+        types, tokens, indexes, ends = self.types, self.tokens, self.indexes, self.ends
+        root = {'elements': []}
+        open_nodes = [(root, len(types))]  # (node, end of its subtree)
+        for node in range(len(types)):
+            while open_nodes[-1][1] <= node:
+                open_nodes.pop()
+            elements = open_nodes[-1][0]['elements']
+            name = symbol_names[types[node]]
+            if tokens[node] == NO_TOKEN:
+                element = {'type': name, 'elements': [], 'index': indexes[node]}
+                open_nodes.append((element, ends[node]))
             else:
-                # Successfully matched the rule
-                print(f"Matched rule: {rule_name} -> {production}")
-                return {'type': rule_name, 'elements': parsed_elements, 'index': current_index}
-        # Failed to match any production
-        print(f"Failed to parse rule: {rule_name}, Tokens: {tokens[index:]}, Index: {index}")
-        return None
-    else:
-        raise ValueError(f"Invalid rule definition for '{rule_name}'.")
+                token = token_names[tokens[node]]
+                element = {'type': name, 'token': token, 'value': grammar[name][token], 'index': indexes[node]}
+            elements.append(element)
+        return root['elements'][0]
 
+    @classmethod
+    def from_dict(cls, parse_tree):
+        """
+        Converts a dict tree from parse_tokens to an arena.
+        """
+        arena = cls()
+        types, tokens, indexes, ends = arena.types, arena.tokens, arena.indexes, arena.ends
+        # Stack entries are (dict node, None) or (None, arena node to close)
+        stack = [(parse_tree, None)]
+        while stack:
+            element, closing = stack.pop()
+            if element is None:
+                ends[closing] = len(types)
+                continue
+            node = len(types)
+            types.append(symbol_ids[element['type']])
+            indexes.append(element['index'])
+            if 'token' in element:
+                tokens.append(token_ids[element['token']])
+                ends.append(node + 1)
+            else:
+                tokens.append(NO_TOKEN)
+                ends.append(0)
+                stack.append((None, node))
+                stack.extend((child, None) for child in reversed(element['elements']))
+        return arena
 
-def parse_Start(tokens):
-    result = parse_rule('Start', tokens, 0)
-    if result is not None and result['index'] == len(tokens):
-        return result
-    else:
-        raise ValueError("Error: Unable to parse the input text according to the grammar.")
+
+def parse_arena(ids, start='Start', stats=None):
+    """
+    parse_tokens for token IDs (from tokenize_ids), building a ParseArena instead of
+    dicts. Raises the same errors and traces the same steps.
+    """
+    trace = trace_hook if trace_level >= TRACE_SYMBOLS else None
+    token_count = len(ids)
+    # Every token adds at most a few rule nodes, 32-bit offsets do up to a billion tokens
+    arena = ParseArena('I' if token_count < 1 << 30 else 'Q')
+    types, tokens, indexes, ends = arena.types, arena.tokens, arena.indexes, arena.ends
+    index = 0
+    productions = 0
+    # Stack entries are symbol IDs; ~node closes an open rule node
+    stack = [symbol_ids[start]]
+    while stack:
+        symbol = stack.pop()
+        if symbol < 0:
+            indexes[~symbol] = index
+            ends[~symbol] = len(types)
+            continue
+
+        token_id = ids[index] if index < token_count else None
+        if symbol_is_terminal[symbol]:
+            if token_id is None or token_symbols[token_id] != symbol:
+                raise_parse_error(symbol_names[symbol], None if token_id is None else token_names[token_id], index)
+            if trace:
+                trace(f"Matched terminal: {token_names[token_id]} to rule: {symbol_names[symbol]}, Index: {index}")
+            index += 1
+            node = len(types)
+            types.append(symbol)
+            tokens.append(token_id)
+            indexes.append(index)
+            ends.append(node + 1)
+            continue
+
+        production = arena_parse_table[symbol].get(END_SYMBOL if token_id is None else token_symbols[token_id])
+        if production is None:
+            raise_parse_error(symbol_names[symbol], None if token_id is None else token_names[token_id], index)
+        if trace:
+            production_names = [symbol_names[child] for child in reversed(production)]
+            trace(f"Expanding rule: {symbol_names[symbol]} -> {production_names}, Index: {index}")
+        productions += 1
+        node = len(types)
+        types.append(symbol)
+        tokens.append(NO_TOKEN)
+        indexes.append(0)
+        ends.append(0)
+        stack.append(~node)
+        stack.extend(production)
+
+    if index != token_count:
+        raise_parse_error(start, token_names[ids[index]], index)
+    if stats is not None:
+        stats.count('productions', productions)
+        stats.count('parse nodes', productions + token_count)
+    return arena
+
+
+# Compact grid: every pattern is stored as one bitmask byte (bit i set when row i is
+# filled) and 9p boundaries are kept as section start offsets into the mask buffer
+row_count = default_tables.row_count
+if default_tables.mask_table is None:
+    raise ValueError("The default grammar must use single token patterns of at most 7 rows.")
+
+# token ID -> mask, used with bytes.translate
+mask_table = default_tables.mask_table
+mask_patterns = [[(mask >> row) & 1 for row in range(row_count)] for mask in range(1 << row_count)]
+# row_bit_tables[row] maps a mask to 1 if the row is filled, for bytes.translate
+row_bit_tables = [bytes((mask >> row) & 1 for mask in range(256)) for row in range(8)]
+
+
+class Grid:
+    """
+    The parsed art as a flat array('B') of pattern masks plus the start offset of every
+    section, shared by the preview and the MIDI generator.
+    """
+    def __init__(self, masks, section_starts):
+        self.masks = masks
+        self.section_starts = section_starts
+
+    @classmethod
+    def from_token_ids(cls, ids, tables=None):
+        """
+        Builds the grid from already validated token IDs of the default grammar, or of
+        tables (a CompiledGrammar with a mask_table).
+        """
+        marked = bytes(ids).translate(mask_table if tables is None else tables.mask_table)
+        section_starts = array('Q', [0])
+        newline = bytes([NEWLINE_MASK])
+        position = marked.find(newline)
+        while position != -1:
+            section_starts.append(position - (len(section_starts) - 1))
+            position = marked.find(newline, position + 1)
+        return cls(array('B', marked.replace(newline, b'')), section_starts)
+
+    @classmethod
+    def from_parse_tree(cls, parse_tree):
+        if isinstance(parse_tree, ParseArena):
+            return cls.from_token_ids(parse_tree.token_ids())
+        return cls.from_token_ids(array('B', map(token_ids.__getitem__, iter_tokens(parse_tree))))
+
+    def __len__(self):
+        return len(self.section_starts)
+
+    def section(self, index):
+        """
+        Returns the masks of one section as a memoryview into the shared buffer.
+        """
+        start = self.section_starts[index]
+        end = self.section_starts[index + 1] if index + 1 < len(self.section_starts) else len(self.masks)
+        return memoryview(self.masks)[start:end]
+
+    def sections(self):
+        for index in range(len(self.section_starts)):
+            yield self.section(index)
+
+    def to_bytes(self):
+        return struct.pack('<Q', len(self.section_starts)) + self.section_starts.tobytes() + self.masks.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        count, = struct.unpack_from('<Q', data)
+        section_starts = array('Q')
+        section_starts.frombytes(data[8:8 + count * section_starts.itemsize])
+        return cls(array('B', data[8 + count * section_starts.itemsize:]), section_starts)
+
+    def to_rows(self, rows=row_count):
+        """
+        Returns the grid in the text_to_array format: rows lists of 0/1 per section.
+        """
+        grid_rows = []
+        for section in self.sections():
+            grid_rows += section_rows(section, rows)
+        return grid_rows
+
+
+def section_rows(section, rows=row_count):
+    """
+    Returns one list of 0/1 per row of a section of column masks, given as mask bytes
+    (a Grid section) or as ints of any width.
+    """
+    if isinstance(section, (bytes, memoryview)):
+        section = bytes(section)
+        return [list(section.translate(row_bit_tables[row])) for row in range(rows)]
+    return [[(mask >> row) & 1 for mask in section] for row in range(rows)]
 
 
 def process_parse_tree(parse_tree, track, logger=None):
-    patterns = []
-    current_section = []
-    all_sections = []
+    grid = Grid.from_parse_tree(parse_tree)
+    if logger:
+        for section in grid.sections():
+            log_section(section, logger)
+    append_events(track, grid.masks, grid.section_starts)
+
+
+def log_section(section, logger):
+    logger(f"Section: {[mask_patterns[mask] for mask in section]}")
+    logger(f"Flipped Section: {section_rows(section)}")
+
+
+NOTE_ON = 0x90
+NOTE_OFF = 0x80
+VELOCITY = 64
+
+
+def append_step(pitches, total_skips, statuses, notes, times):
+    """
+    Appends the events of one step (row) with the given pitches to the three event lists.
+    Returns the number of silent steps carried into the next step.
+    """
+    if not pitches:
+        return total_skips + 1
+    # All note_on events of the step, then all note_off events 100 ticks later
+    count = len(pitches)
+    statuses += [NOTE_ON] * count + [NOTE_OFF] * count
+    notes += pitches + pitches
+    times.append(total_skips * 100)
+    times += [0] * (count - 1)
+    times.append(100)
+    times += [0] * (count - 1)
+    return 0
+
+
+def build_section_events(section, total_skips, statuses, notes, times, rows=row_count):
+    """
+    Pure Python event builder for one section, appending to the three event lists.
+    Returns the number of silent steps carried into the next section. The masks can be
+    ints of any width, rows is the number of rows (time steps) of each mask.
+    """
+    starting_pitch = math.ceil(60 + len(section) / 2)
+    for row in range(rows):
+        bit = 1 << row
+        pitches = [starting_pitch - i for i, mask in enumerate(section) if mask & bit]
+        total_skips = append_step(pitches, total_skips, statuses, notes, times)
+    return total_skips
+
+
+def build_events_numpy(masks, section_starts, total_skips=0):
+    """
+    NumPy version of build_section_events for many sections at once. Returns arrays of
+    the status bytes, notes and delta times, plus the silent steps left over at the end.
+    """
+    np = optional_import('numpy')
+    masks = np.frombuffer(masks, dtype=np.uint8)
+    starts = np.asarray(section_starts, dtype=np.int64)
+    lengths = np.diff(np.append(starts, len(masks)))
+    section_of = np.repeat(np.arange(len(starts)), lengths)
+    # ceil(60 + n / 2) == 60 + (n + 1) // 2, then one pitch lower per pattern
+    starting_pitch = 60 + (lengths + 1) // 2
+    pitches = starting_pitch[section_of] - (np.arange(len(masks)) - starts[section_of])
+
+    # Every filled cell, ordered by time step (section, row) and then by pattern
+    filled = (masks[:, None] >> np.arange(row_count, dtype=np.uint8)) & 1
+    index, row = np.nonzero(filled)
+    steps = section_of[index] * row_count + row
+    order = np.argsort(steps, kind='stable')
+    steps = steps[order]
+    notes = pitches[index[order]]
+
+    total_steps = len(starts) * row_count
+    cell_count = len(steps)
+    if cell_count == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, total_skips + total_steps
+
+    # The first cell of every step carries the rest before it, every step plays for 100 ticks
+    first = np.empty(cell_count, dtype=bool)
+    first[0] = True
+    first[1:] = steps[1:] != steps[:-1]
+    step_starts = np.flatnonzero(first)
+    played_steps = steps[step_starts]
+    skips = np.diff(played_steps, prepend=-1) - 1
+    skips[0] += total_skips
+    step_sizes = np.diff(np.append(step_starts, cell_count))
+    step_of = np.cumsum(first) - 1
+
+    # Each step emits all of its note_on events followed by all of its note_off events
+    on_positions = np.arange(cell_count) + step_starts[step_of]
+    off_positions = on_positions + step_sizes[step_of]
+    statuses = np.empty(2 * cell_count, dtype=np.int64)
+    statuses[on_positions] = NOTE_ON
+    statuses[off_positions] = NOTE_OFF
+    event_notes = np.empty(2 * cell_count, dtype=np.int64)
+    event_notes[on_positions] = notes
+    event_notes[off_positions] = notes
+    times = np.zeros(2 * cell_count, dtype=np.int64)
+    times[on_positions[step_starts]] = skips * 100
+    times[off_positions[step_starts]] = 100
+    return statuses, event_notes, times, int(total_steps - 1 - played_steps[-1])
+
+
+def build_events(masks, section_starts, total_skips=0):
+    """
+    Builds the note events of every section, in bulk with NumPy when it is installed.
+    Returns lists of status bytes, notes and delta times plus the silent steps carried
+    into whatever comes next.
+    """
+    if optional_import('numpy') is not None:
+        statuses, notes, times, total_skips = build_events_numpy(masks, section_starts, total_skips)
+        return statuses.tolist(), notes.tolist(), times.tolist(), total_skips
+
+    return default_tables.build_events(Grid(masks, section_starts).sections(), total_skips)
+
+
+def append_events(track, masks, section_starts, total_skips=0):
+    """
+    Appends the events of every section to track as mido Messages.
+    Returns the silent steps carried into whatever comes next.
+    """
+    mido = optional_import('mido')
+    if mido is None:
+        raise ImportError("Building mido tracks needs the mido package.")
+    statuses, notes, times, total_skips = build_events(masks, section_starts, total_skips)
+    for status, note, time in zip(statuses, notes, times):
+        message_type = 'note_on' if status == NOTE_ON else 'note_off'
+        track.append(mido.Message(message_type, note=note, velocity=VELOCITY, time=time))
+    return total_skips
+
+
+# Native Standard MIDI File writer: events are packed straight into a bytearray using
+# running status, producing the same bytes as MidiFile.save on a single track
+END_OF_TRACK = b'\x00\xff\x2f\x00'
+PRECOMPUTED_RESTS = 256  # delta times of up to this many steps are encoded once
+
+
+def encode_variable_length(value):
+    """
+    Encodes a MIDI delta time as a variable-length quantity.
+    """
+    result = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        result.append(0x80 | (value & 0x7f))
+        value >>= 7
+    result.reverse()
+    return bytes(result)
+
+
+# Delta times are multiples of 100 ticks; longer rests are rare and encoded when they occur,
+# so the table stays the same size however many distinct rests the inputs have
+variable_lengths = {steps * 100: encode_variable_length(steps * 100) for steps in range(PRECOMPUTED_RESTS)}
+
+
+def midi_header(ticks_per_beat=480):
+    return b'MThd' + struct.pack('>Lhhh', 6, 1, 1, ticks_per_beat)
+
+
+def check_notes(notes):
+    if notes and (min(notes) < 0 or max(notes) > 127):
+        raise ValueError("Note out of MIDI range 0..127, the section is too long.")
+
+
+def encode_events(statuses, notes, times, running_status=None):
+    """
+    Encodes note events as MIDI track data. Returns the bytes and the running status
+    to pass in when encoding the events that follow.
+    """
+    check_notes(notes)
+    data = bytearray()
+    for status, note, time in zip(statuses, notes, times):
+        data += variable_lengths.get(time) or encode_variable_length(time)
+        if status != running_status:
+            data.append(status)
+            running_status = status
+        data.append(note)
+        data.append(VELOCITY)
+    return data, running_status
+
+
+def write_midi(statuses, notes, times, dst=None, ticks_per_beat=480):
+    """
+    Writes the events as a single track MIDI file to dst, which can be a path or a binary
+    file object. Returns the file contents as bytes when dst is None.
+    """
+    data, _ = encode_events(statuses, notes, times)
+    return write_track(data, dst, ticks_per_beat)
+
+
+def write_track(data, dst=None, ticks_per_beat=480):
+    """
+    Writes already encoded track data as a single track MIDI file, see write_midi.
+    """
+    contents = midi_header(ticks_per_beat) + b'MTrk' + struct.pack('>L', len(data) + len(END_OF_TRACK))
+    contents += data + END_OF_TRACK
+    if dst is None:
+        return bytes(contents)
+    if isinstance(dst, (str, os.PathLike)):
+        with open(dst, 'wb') as f:
+            f.write(contents)
+    else:
+        dst.write(contents)
+
+
+class MidiStreamWriter:
+    """
+    Writes a single track MIDI file incrementally with the native encoder. The track
+    length is patched in by close(), so file must be seekable.
+    """
+    def __init__(self, file, ticks_per_beat=480):
+        self.file = file
+        self.running_status = None
+        self.track_length = 0
+        file.write(midi_header(ticks_per_beat) + b'MTrk')
+        self.length_position = file.tell()
+        file.write(struct.pack('>L', 0))
+
+    def write_events(self, statuses, notes, times):
+        data, self.running_status = encode_events(statuses, notes, times, self.running_status)
+        self.file.write(data)
+        self.track_length += len(data)
+
+    def close(self):
+        self.file.write(END_OF_TRACK)
+        self.track_length += len(END_OF_TRACK)
+        end_position = self.file.tell()
+        self.file.seek(self.length_position)
+        self.file.write(struct.pack('>L', self.track_length))
+        self.file.seek(end_position)
+
+
+# Streaming conversion: the input is read in chunks, validated against the grammar as it
+# arrives and every section is written out as soon as its closing 9p (or the end) is seen
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+def iter_token_chunks(src, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields arrays of token IDs for consecutive chunks of src. src can be a path (read
+    through mmap), a text or binary file object, an mmap or a bytes-like object.
+    """
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from iter_token_chunks(mapped, chunk_size)
+        return
+
+    chunk_size -= chunk_size % token_max_length
+    offset = 0
+    if not hasattr(src, 'read'):
+        view = memoryview(src).cast('B')
+        for offset in range(0, len(view), chunk_size):
+            yield tokenize_ids(view[offset:offset + chunk_size], offset)
+        return
+
+    leftover = None
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        if leftover:
+            data = leftover + data
+        usable = len(data) - len(data) % token_max_length
+        leftover = data[usable:]
+        if usable:
+            yield tokenize_ids(data[:usable], offset)
+            offset += usable
+    if leftover:
+        raise TokenizeError(f"Failed to tokenize: incomplete token at byte {offset}.", offset)
+
+
+class ConversionCancelled(Exception):
+    """
+    Raised by the streaming pipeline when its cancel event is set.
+    """
+
+
+def iter_sections(src, chunk_size=STREAM_CHUNK_SIZE, stats=None, progress=None, cancel=None):
+    """
+    Streams src through the tokenizer and the LL(1) parse table and yields every section
+    as a bytearray of pattern masks once it is complete. Only the current section is kept.
+    progress is called with the number of tokens processed after every chunk, and the
+    stream stops with ConversionCancelled once cancel (a threading.Event) is set.
+    """
+    stack = ['Start']
+    index = 0
+    section = bytearray()
+    for ids in iter_token_chunks(src, chunk_size):
+        if cancel is not None and cancel.is_set():
+            raise ConversionCancelled("Conversion cancelled.")
+        for token_id in ids:
+            advance_parser(stack, token_names[token_id], index)
+            index += 1
+            mask = mask_table[token_id]
+            if mask == NEWLINE_MASK:
+                yield section
+                section = bytearray()
+            else:
+                section.append(mask)
+        if stats is not None:
+            stats.count('tokens', len(ids))
+        if progress is not None:
+            progress(index)
+    advance_parser(stack, None, index)
+    yield section
+
+
+def stream_text_to_midi(src, dst, chunk_size=STREAM_CHUNK_SIZE, stats=None, logger=None, progress=None, cancel=None):
+    """
+    Converts src to MIDI section by section, so peak memory depends on the largest section
+    rather than the input size. dst can be a path or a binary file object; a partially
+    written dst path is removed if the input turns out to be invalid or the run is cancelled.
+    See iter_sections for progress and cancel.
+    """
+    if isinstance(dst, (str, os.PathLike)):
+        try:
+            with open(dst, 'wb') as f:
+                stream_text_to_midi(src, f, chunk_size, stats, logger, progress, cancel)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(dst)
+            raise
+        return
+    if not dst.seekable():
+        with tempfile.TemporaryFile() as spool:
+            stream_text_to_midi(src, spool, chunk_size, stats, logger, progress, cancel)
+            spool.seek(0)
+            shutil.copyfileobj(spool, dst)
+        return
+
+    writer = MidiStreamWriter(dst)
     total_skips = 0
+    for section in iter_sections(src, chunk_size, stats, progress, cancel):
+        if logger:
+            log_section(section, logger)
+        statuses, notes, times, total_skips = build_events(section, [0], total_skips)
+        writer.write_events(statuses, notes, times)
+        if stats is not None:
+            stats.count('sections')
+            stats.count('midi events', len(statuses))
+    writer.close()
 
-    def extract_patterns(node):
-        if node['type'] in ['SingleNote', 'DoubleNote', 'TripleNote', 'QuadNote', 'QuintNote']:
-            patterns.append(node['value'])
-        elif node['type'] == 'NewColumn':
-            patterns.append('newline')
-        elif 'elements' in node:
-            for child in node['elements']:
-                extract_patterns(child)
 
-    extract_patterns(parse_tree)
+# Parse tree dumps are written chunk by chunk so the whole text is never built in memory.
+# 'jsonl' writes one flat record per node, 'json' the nested pretty-printed layout.
+def iter_parse_tree_jsonl(parse_tree):
+    """
+    Yields one JSON line per node in preorder, children refer to their parent's id.
+    """
+    if isinstance(parse_tree, ParseArena):
+        for node, parent in enumerate(parse_tree.parents()):
+            record = {'id': node, 'parent': parent, 'type': symbol_names[parse_tree.types[node]],
+                      'index': parse_tree.indexes[node]}
+            if parse_tree.tokens[node] != NO_TOKEN:
+                record['token'] = token_names[parse_tree.tokens[node]]
+            yield json.dumps(record, separators=(',', ':')) + '\n'
+        return
+    stack = [(parse_tree, -1)]
+    node_id = 0
+    while stack:
+        node, parent = stack.pop()
+        record = {'id': node_id, 'parent': parent, 'type': node['type'], 'index': node['index']}
+        if 'token' in node:
+            record['token'] = node['token']
+        yield json.dumps(record, separators=(',', ':')) + '\n'
+        if 'elements' in node:
+            stack.extend((child, node_id) for child in reversed(node['elements']))
+        node_id += 1
+
+
+def iter_json(obj, indent=2):
+    """
+    Yields the same text as json.dumps(obj, indent=indent) in chunks, using an explicit
+    stack so deeply nested trees do not hit the recursion limit. Open containers only keep
+    their nesting level, indents are built when they are written.
+    """
+    # Stack entries are [iterator over (key or None, value) pairs, level, closing bracket, first]
+    stack = []
+    value = obj
+    while True:
+        if isinstance(value, (dict, list)) and value:
+            if isinstance(value, dict):
+                yield '{'
+                stack.append([iter(value.items()), len(stack) + 1, '}', True])
+            else:
+                yield '['
+                stack.append([zip(repeat(None), value), len(stack) + 1, ']', True])
+        else:
+            yield json.dumps(value)
+
+        while stack:
+            entry = stack[-1]
+            items, level, closing, first = entry
+            item = next(items, None)
+            if item is not None:
+                key, value = item
+                prefix = '\n' + ' ' * (indent * level)
+                if key is not None:
+                    prefix += f"{json.dumps(key)}: "
+                yield prefix if first else ',' + prefix
+                entry[3] = False
+                break
+            stack.pop()
+            yield '\n' + ' ' * (indent * (level - 1)) + closing
+        else:
+            return
+
+
+def iter_json_lines(obj, indent=2):
+    """
+    iter_json split into lines (without the newlines). A chunk of iter_json contains at
+    most one newline.
+    """
+    line = []
+    for chunk in iter_json(obj, indent):
+        head, newline, tail = chunk.partition('\n')
+        line.append(head)
+        if newline:
+            yield ''.join(line)
+            line = [tail]
+    yield ''.join(line)
+
+
+def dump_parse_tree(parse_tree, dst, tree_format='jsonl'):
+    """
+    Writes the parse tree to dst (a path or a text file object) as 'jsonl' or 'json'.
+    """
+    if tree_format == 'jsonl':
+        chunks = iter_parse_tree_jsonl(parse_tree)
+    elif tree_format == 'json':
+        chunks = iter_json(parse_tree.to_dict() if isinstance(parse_tree, ParseArena) else parse_tree)
+    else:
+        raise ValueError(f"Unknown parse tree format '{tree_format}'.")
+
+    if isinstance(dst, (str, os.PathLike)):
+        with open(dst, 'w') as f:
+            f.writelines(chunks)
+    else:
+        dst.writelines(chunks)
+
+
+# Content-addressed conversion cache. Whole inputs are keyed by the hash of their text
+# and every section by the hash of its masks, so a section repeated anywhere is compiled once.
+# The directory can be shared by several processes; each one trims it by file mtime (reads
+# touch the file) down to DISK_TRIM_FRACTION of the limits whenever it sees them exceeded.
+cache_file_pattern = re.compile(r'\w+-[0-9a-f]{64}$')
+DISK_TRIM_FRACTION = 0.9
+
+
+class ConversionCache:
+    """
+    LRU cache of conversion results (bytes) bounded by entry count and total size,
+    optionally backed by a directory that survives between runs. The directory is bounded
+    by max_disk_entries and max_disk_bytes, which default to the in-memory limits.
+    """
+    def __init__(self, max_entries=4096, max_bytes=64 << 20, directory=None, max_disk_entries=None,
+                 max_disk_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_entries = max_entries if max_disk_entries is None else max_disk_entries
+        self.max_disk_bytes = max_bytes if max_disk_bytes is None else max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.disk_entries = 0
+        self.disk_size = 0
+        self.disk_evictions = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.trim_directory()
+
+    @staticmethod
+    def key(kind, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return f"{kind}-{hashlib.sha256(data).hexdigest()}"
+
+    def get(self, key, persist=True):
+        """
+        Returns the cached value or None. Looks in the directory too when the cache has
+        one and persist is set; keys only ever put with persist=False never touch the disk.
+        """
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+        if persist and self.directory:
+            try:
+                with open(os.path.join(self.directory, key), 'rb') as f:
+                    value = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self.hits += 1
+                self.disk_hits += 1
+                with suppress(OSError):
+                    os.utime(os.path.join(self.directory, key))  # recently used, trimmed last
+                self.store(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value, persist=True):
+        """
+        Stores value in memory, and on disk too when the cache has a directory and persist is set.
+        """
+        self.store(key, value)
+        if persist and self.directory and len(value) <= self.max_disk_bytes:
+            path = os.path.join(self.directory, key)
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'wb') as f:
+                f.write(value)
+            os.replace(temporary_path, path)
+            self.disk_entries += 1
+            self.disk_size += len(value)
+            if self.disk_entries > self.max_disk_entries or self.disk_size > self.max_disk_bytes:
+                self.trim_directory()
+
+    def trim_directory(self):
+        """
+        Rescans the directory, which other processes may be writing to as well, and removes
+        the least recently used files until it is within DISK_TRIM_FRACTION of the limits.
+        """
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if cache_file_pattern.match(entry.name):
+                    with suppress(FileNotFoundError):  # removed by another process meanwhile
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        count = len(files)
+        size = sum(file_size for _, file_size, _ in files)
+        if count > self.max_disk_entries or size > self.max_disk_bytes:
+            max_count = int(self.max_disk_entries * DISK_TRIM_FRACTION)
+            max_size = int(self.max_disk_bytes * DISK_TRIM_FRACTION)
+            for _, file_size, path in sorted(files):
+                if count <= max_count and size <= max_size:
+                    break
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+                count -= 1
+                size -= file_size
+                self.disk_evictions += 1
+        self.disk_entries = count
+        self.disk_size = size
+
+    def store(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        old_value = self.entries.pop(key, None)
+        if old_value is not None:
+            self.size -= len(old_value)
+        self.entries[key] = value
+        self.size += len(value)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk hits': self.disk_hits,
+            'hit rate': self.hit_rate(),
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max entries': self.max_entries,
+            'max bytes': self.max_bytes,
+            'disk entries': self.disk_entries,
+            'disk bytes': self.disk_size,
+            'disk evictions': self.disk_evictions,
+            'max disk entries': self.max_disk_entries,
+            'max disk bytes': self.max_disk_bytes,
+        }
+
+
+def pack_section_events(statuses, notes, times, trailing_skips):
+    check_notes(notes)
+    return (struct.pack('<II', len(statuses), trailing_skips) + bytes(statuses) + bytes(notes)
+            + array('I', times).tobytes())
+
+
+def unpack_section_events(data):
+    count, trailing_skips = struct.unpack_from('<II', data)
+    statuses = list(data[8:8 + count])
+    notes = list(data[8 + count:8 + 2 * count])
+    times = array('I')
+    times.frombytes(data[8 + 2 * count:])
+    return statuses, notes, times.tolist(), trailing_skips
 
-    for p in patterns:
-        if p == 'newline':
-            if current_section:
-                all_sections.append(current_section)
-                current_section = []
+
+def build_events_cached(grid, cache):
+    """
+    build_events that compiles every distinct section once. Sections are cached as if
+    nothing was carried into them; the rest carried in from the previous section is
+    added to the first delta time when the cached events are reused.
+    """
+    statuses, notes, times = [], [], []
+    total_skips = 0
+    for section in grid.sections():
+        key = cache.key('section', section)
+        data = cache.get(key, persist=False)
+        if data is None:
+            data = pack_section_events(*build_events(section, [0]))
+            cache.put(key, data, persist=False)
+        section_statuses, section_notes, section_times, trailing_skips = unpack_section_events(data)
+        if section_statuses:
+            section_times[0] += total_skips * 100
+            total_skips = trailing_skips
         else:
-            current_section.append(p)
+            total_skips += trailing_skips
+        statuses += section_statuses
+        notes += section_notes
+        times += section_times
+    return statuses, notes, times, total_skips
+
 
-    if current_section:
-        all_sections.append(current_section)
+def cached_grid(text, cache, stats):
+    """
+    Returns the Grid of text, tokenizing and parsing only if it is not cached yet.
+    """
+    key = cache.key('grid', text)
+    data = cache.get(key)
+    if data is not None:
+        stats.count('cache hits')
+        return Grid.from_bytes(data)
+    parse_tree = run_phases(text, stats)
+    with stats.phase('build grid'):
+        grid = Grid.from_parse_tree(parse_tree)
+    cache.put(key, grid.to_bytes())
+    return grid
 
-    # Process each section
-    for section in all_sections:
+
+def cached_midi(text, cache, stats, logger=None):
+    """
+    Returns the MIDI file contents for text from the cache, building and storing them on a miss.
+    """
+    key = cache.key('midi', text)
+    contents = cache.get(key)
+    if contents is not None:
+        stats.count('cache hits')
+        return contents
+    if has_run_syntax(text):
+        with stats.phase('compile runs'):
+            contents = run_text_to_midi(text)
+        cache.put(key, contents)
+        return contents
+    grid = cached_grid(text, cache, stats)
+    with stats.phase('build events'):
         if logger:
-            logger(f"Section: {section}")
-        flipped_section = [list(row) for row in zip(*section)]
+            for section in grid.sections():
+                log_section(section, logger)
+        statuses, notes, times, _ = build_events_cached(grid, cache)
+    stats.count('midi events', len(statuses))
+    contents = write_midi(statuses, notes, times)
+    cache.put(key, contents)
+    return contents
+
+
+# Parallel conversion: the token stream is split at 9p into chunks of whole sections that
+# worker processes check and compile on their own, as if no rest was carried in and no
+# running status was set. Stitching only re-encodes the first event of every chunk: the
+# rest carried over from the chunks before is added to its delta time and its status byte
+# is dropped when it repeats the last status written.
+# Run with: python -m logic convert INPUT -w WORKERS
+PARALLEL_MIN_CHUNK_TOKENS = 1 << 16
+newline_token = default_tables.token_masks.index(None)
+
+
+def split_sections(ids, chunk_tokens):
+    """
+    Splits token IDs at newline tokens into byte strings of whole sections, each at least
+    chunk_tokens long except the last. The newlines between chunks are dropped.
+    """
+    data = bytes(ids)
+    newline = bytes((newline_token,))
+    chunks = []
+    start = 0
+    while True:
+        split = data.find(newline, start + chunk_tokens)
+        if split == -1:
+            chunks.append(data[start:])
+            return chunks
+        chunks.append(data[start:split])
+        start = split + 1
+
+
+def compile_chunk(chunk):
+    """
+    Runs in a worker process: checks a chunk of sections against the grammar and encodes
+    its events. Returns (first event as (status, note, time) or None, encoded data of the
+    other events, last status, silent steps at the end, event count).
+    """
+    default_tables.check_ids(chunk)
+    grid = Grid.from_token_ids(chunk)
+    statuses, notes, times, trailing_skips = build_events(grid.masks, grid.section_starts)
+    if not statuses:
+        return None, b'', None, trailing_skips, 0
+    check_notes(notes[:1])
+    data, last_status = encode_events(statuses[1:], notes[1:], times[1:], statuses[0])
+    return (statuses[0], notes[0], times[0]), bytes(data), last_status, trailing_skips, len(statuses)
+
+
+def stitch_chunks(chunks):
+    """
+    Joins compiled chunks into one track. Returns the track data and the event count.
+    """
+    data = bytearray()
+    running_status = None
+    total_skips = 0
+    event_count = 0
+    for first, rest, last_status, trailing_skips, count in chunks:
+        if first is None:
+            total_skips += trailing_skips
+            continue
+        status, note, time = first
+        head, _ = encode_events([status], [note], [time + total_skips * 100], running_status)
+        data += head
+        data += rest
+        running_status = last_status
+        total_skips = trailing_skips
+        event_count += count
+    return data, event_count
+
+
+def parallel_text_to_midi(text, dst=None, workers=None, chunk_tokens=None, stats=None, logger=None):
+    """
+    Converts text with the native backend, compiling chunks of sections across worker
+    processes. Gives the same bytes and raises the same errors as the serial conversion.
+    dst is handled like in write_midi. chunk_tokens defaults to about four chunks per worker.
+    """
+    if stats is None:
+        stats = PipelineStats()
+    workers = workers or os.cpu_count() or 1
+    if has_run_syntax(text):
+        with stats.phase('expand runs'):
+            text = expand_runs(text)
+    with stats.phase('tokenize'):
+        ids = tokenize_ids(text)
+    stats.count('tokens', len(ids))
+    if chunk_tokens is None:
+        chunk_tokens = max(PARALLEL_MIN_CHUNK_TOKENS, -(-len(ids) // (4 * workers)))
+
+    with stats.phase('compile sections'):
+        chunks = split_sections(ids, chunk_tokens) if workers > 1 else [bytes(ids)]
+        stats.count('chunks', len(chunks))
+        if len(chunks) == 1:
+            results = [compile_chunk(chunks[0])]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+                futures = [executor.submit(compile_chunk, chunk) for chunk in chunks]
+                results = []
+                error = None
+                for future in futures:
+                    try:
+                        results.append(future.result())
+                    except ParseError:
+                        # Chunks are only valid together if each is, but the error has to be
+                        # the one the whole input gives
+                        default_tables.check_ids(ids)
+                        raise
+                    except ValueError as e:
+                        error = error or e
+                if error is not None:
+                    raise error
+        data, event_count = stitch_chunks(results)
+    stats.count('midi events', event_count)
+    if logger:
+        for section in Grid.from_token_ids(ids).sections():
+            log_section(section, logger)
+    with stats.phase('save'):
+        return write_track(data, dst)
+
+
+# Run-length syntax: a token followed by {N} stands for N copies of it and a group (...){N}
+# for N copies of the group, e.g. 0a{40} or (0b0a{3}9p){8}. Groups can nest and contain
+# 9p. Counts are in braces because every token starts with a digit. Inputs are kept as
+# runs of (item, count, size), where item is a token ID or a list of runs (a group) and
+# size the number of tokens in one copy of item, and are only expanded token by token
+# where a whole token stream is needed. A few bytes of runs can stand for any number of
+# tokens, so expansion and the MIDI data compiled from runs are limited.
+RUN_SYNTAX = '{}()'
+max_expanded_tokens = 1 << 25
+max_run_midi_bytes = 1 << 28
+run_pattern = re.compile(r'\{(\d+)\}|[(){}]|[^(){}]+')
+
+
+class RunLimitError(ValueError):
+    """
+    Raised when run-length input expands to more than max_expanded_tokens tokens or
+    compiles to more than max_run_midi_bytes of MIDI data.
+    """
+
+
+def has_run_syntax(text):
+    return isinstance(text, str) and any(mark in text for mark in RUN_SYNTAX)
+
+
+def parse_runs(text):
+    """
+    Parses text with run-length syntax into a list of runs. Consecutive equal tokens are
+    merged into one run. Raises TokenizeError with the byte offset of the problem.
+    """
+    groups = [[]]
+    opened = []  # offsets of the open parentheses
+    repeatable = False  # whether a {N} may follow
+    for match in run_pattern.finditer(text):
+        position = match.start()
+        chunk = match.group()
+        runs = groups[-1]
+        if chunk[0] in '{}':
+            if not repeatable or not match.group(1) or int(match.group(1)) < 1:
+                raise TokenizeError(f"Failed to tokenize: a repeat at byte {position} must follow a token or a group "
+                                    f"and be a count of at least 1 in braces.", position)
+            # {N} repeats only the last token, which may already be merged into a longer run
+            runs[-1][1] += int(match.group(1)) - 1
+            repeatable = False
+        elif chunk == '(':
+            groups.append([])
+            opened.append(position)
+            repeatable = False
+        elif chunk == ')':
+            if not opened:
+                raise TokenizeError(f"Failed to tokenize: unmatched ')' at byte {position}.", position)
+            start = opened.pop()
+            group = groups.pop()
+            if not group:
+                raise TokenizeError(f"Failed to tokenize: empty group at byte {start}.", start)
+            groups[-1].append([group, 1, sum(count * size for _, count, size in group)])
+            repeatable = True
+        else:
+            for token_id, copies in groupby(tokenize_ids(chunk, position)):
+                count = sum(1 for _ in copies)
+                if runs and runs[-1][0] == token_id:
+                    runs[-1][1] += count
+                else:
+                    runs.append([token_id, count, 1])
+            repeatable = True
+    if opened:
+        raise TokenizeError(f"Failed to tokenize: unclosed '(' at byte {opened[-1]}.", opened[-1])
+    return groups[0]
+
+
+def iter_run_ids(runs):
+    """
+    Yields the token IDs of runs one by one, expanding every repeat lazily.
+    """
+    for item, count, _ in runs:
+        if isinstance(item, int):
+            yield from repeat(item, count)
+        else:
+            for _ in range(count):
+                yield from iter_run_ids(item)
+
+
+def expand_runs(text, limit=None):
+    """
+    Returns text with every run written out, in the plain token syntax. Raises
+    RunLimitError when that is more than limit (default max_expanded_tokens) tokens.
+    """
+    runs = parse_runs(text)
+    limit = max_expanded_tokens if limit is None else limit
+    token_count = sum(count * size for _, count, size in runs)
+    if token_count > limit:
+        raise RunLimitError(f"The input expands to {token_count} tokens, more than the limit of {limit}.")
+    return ''.join(map(token_names.__getitem__, iter_run_ids(runs)))
+
+
+def feed_runs(stack, runs, index=0):
+    """
+    Feeds runs to an advance_parser stack and returns the index of the next token. As
+    soon as one copy of a run leaves the parser in the state it started in, the other
+    copies cannot change anything and are skipped.
+    """
+    for item, count, size in runs:
+        for copy in range(count):
+            before = stack[:]
+            if isinstance(item, int):
+                advance_parser(stack, token_names[item], index)
+                index += 1
+            else:
+                index = feed_runs(stack, item, index)
+            if stack == before:
+                index += (count - copy - 1) * size
+                break
+    return index
+
+
+def check_runs(runs):
+    """
+    Validates runs against the grammar, raising ParseError like parse_Start would for the
+    expanded input.
+    """
+    stack = ['Start']
+    advance_parser(stack, None, feed_runs(stack, runs))
+
+
+def is_silent(runs):
+    """
+    Returns True if runs only hold silent patterns (no notes and no 9p).
+    """
+    return all(mask_table[item] == 0 if isinstance(item, int) else is_silent(item) for item, _, _ in runs)
+
+
+def build_run_section_events(columns, total_skips, statuses, notes, times):
+    """
+    build_section_events for a section given as (mask, count) column runs. Silent runs
+    only move the pitch, so they cost the same whatever their length.
+    """
+    starting_pitch = 60 + (sum(count for _, count in columns) + 1) // 2  # ceil(60 + n / 2)
+    for row in range(row_count):
+        bit = 1 << row
+        pitches = []
+        position = 0
+        for mask, count in columns:
+            if mask & bit:
+                pitches += range(starting_pitch - position, starting_pitch - position - count, -1)
+            position += count
+        total_skips = append_step(pitches, total_skips, statuses, notes, times)
+    return total_skips
+
+
+class RunCompiler:
+    """
+    Encodes MIDI track data straight from checked runs. Once a copy of a repeated group
+    leaves the compiler in the state it started in, the remaining copies are added in
+    one step: silent copies as a single longer delta time, the others by repeating the
+    bytes of that copy.
+    """
+    # A section can only hold this many notes per row before they leave the 0..127 range
+    max_filled_columns = 128
+
+    def __init__(self):
+        self.columns = []  # (mask, count) runs of the current section
+        self.filled = 0  # columns of the current section with at least one note
+        self.total_skips = 0
+        self.running_status = None
+        self.data = bytearray()
+
+    def add_columns(self, mask, count):
+        if mask:
+            self.filled += count
+            if self.filled > self.max_filled_columns:
+                raise ValueError("Note out of MIDI range 0..127, the section is too long.")
+        if self.columns and self.columns[-1][0] == mask:
+            self.columns[-1] = (mask, self.columns[-1][1] + count)
+        else:
+            self.columns.append((mask, count))
+
+    def end_section(self):
+        statuses, notes, times = [], [], []
+        self.total_skips = build_run_section_events(self.columns, self.total_skips, statuses, notes, times)
+        data, self.running_status = encode_events(statuses, notes, times, self.running_status)
+        self.data += data
+        self.check_size(0)
+        self.columns = []
+        self.filled = 0
+
+    def feed(self, runs):
+        for item, count, size in runs:
+            if isinstance(item, int):
+                mask = mask_table[item]
+                if mask == NEWLINE_MASK:
+                    for _ in range(count):
+                        self.end_section()
+                else:
+                    self.add_columns(mask, count)
+            elif is_silent(item):
+                self.add_columns(0, count * size)
+            else:
+                self.feed_group(item, count)
+
+    def feed_group(self, group, count):
+        for copy in range(count):
+            columns, total_skips, running_status = self.columns[:], self.total_skips, self.running_status
+            start = len(self.data)
+            self.feed(group)
+            if self.columns != columns or self.running_status != running_status:
+                continue
+            remaining = count - copy - 1
+            if len(self.data) == start:
+                self.total_skips += (self.total_skips - total_skips) * remaining
+                return
+            if self.total_skips == total_skips:
+                self.check_size((len(self.data) - start) * remaining)
+                self.data += self.data[start:] * remaining
+                return
+
+    def check_size(self, added):
+        if len(self.data) + added > max_run_midi_bytes:
+            raise RunLimitError(f"The input compiles to more than {max_run_midi_bytes} bytes of MIDI data.")
+
+    def finish(self):
+        self.end_section()
+        return self.data
+
+
+def run_text_to_midi(text, dst=None):
+    """
+    Converts text with run-length syntax to a MIDI file without expanding the runs.
+    The result is the same as converting expand_runs(text). dst works like in write_midi.
+    """
+    runs = parse_runs(text)
+    check_runs(runs)
+    compiler = RunCompiler()
+    compiler.feed(runs)
+    return write_track(compiler.finish(), dst)
+
+
+def run_phases(text, stats):
+    """
+    Tokenizes and parses text into a ParseArena, recording both phases in stats.
+    """
+    with stats.phase('tokenize'):
+        ids = tokenize_ids(text)
+    stats.count('tokens', len(ids))
+    with stats.phase('parse'):
+        parse_tree = parse_arena(ids, stats=stats)
+    return parse_tree
+
+
+def log_stats(stats, logger=None):
+    for line in stats.summary_lines():
         if logger:
-            logger(f"Flipped Section: {flipped_section}")
-
-        starting_pitch = math.ceil(60 + len(section) / 2)
-        for column in flipped_section:
-            current_pitch = starting_pitch
-            switch1, switch2 = True, True
-            empty_switch = True
-            for note in column:
-                if note == 1:
-                    empty_switch = False
-                    if switch1:
-                        track.append(Message('note_on', note=current_pitch, velocity=64, time=(total_skips * 100)))
-                        total_skips = 0
-                        switch1 = False
-                    else:
-                        track.append(Message('note_on', note=current_pitch, velocity=64, time=0))
-                current_pitch -= 1
-
-            current_pitch = starting_pitch
-            for note in column:
-                if note == 1:
-                    if switch2:
-                        track.append(Message('note_off', note=current_pitch, velocity=64, time=100))
-                        switch2 = False
-                    else:
-                        track.append(Message('note_off', note=current_pitch, velocity=64, time=0))
-                current_pitch -= 1
-
-            if empty_switch:
-                total_skips += 1
-
-
-def text_to_midi2(text, output_file="result_FIX.mid", logger=None):
-    try:
-        tokens = tokenize(text)
-        parse_tree = parse_Start(tokens)
+            logger(line)
+        else:
+            print(line)
+
 
-        # Print the parse tree and save to a file
-        parse_tree_str = json.dumps(parse_tree, indent=2)
-        print(parse_tree_str)
-        with open('parse_tree.txt', 'w') as f:
-            f.write(parse_tree_str)
+def convert_text_to_midi(text, output_file, logger=None, stats=None, backend='native',
+                         tree_output=None, tree_format='jsonl', cache=None, workers=None):
+    """
+    Converts text to a MIDI file like text_to_midi2, but raises errors instead of
+    logging them. Returns the PipelineStats of the run. With workers, uncached native
+    conversions compile their sections in that many processes (see parallel_text_to_midi).
+    """
+    if stats is None:
+        stats = PipelineStats()
+    if has_run_syntax(text) and (cache is None or backend != 'native' or tree_output is not None):
+        if backend == 'native' and tree_output is None:
+            with stats.phase('compile runs'):
+                run_text_to_midi(text, output_file)
+            return stats
+        with stats.phase('expand runs'):
+            text = expand_runs(text)
+    if cache is not None and backend == 'native' and tree_output is None:
+        contents = cached_midi(text, cache, stats, logger)
+        with stats.phase('save'):
+            with open(output_file, 'wb') as f:
+                f.write(contents)
+        return stats
+    if workers is not None and backend == 'native' and tree_output is None:
+        parallel_text_to_midi(text, output_file, workers, stats=stats, logger=logger)
+        return stats
 
+    parse_tree = run_phases(text, stats)
+
+    # Print the parse tree when tracing every symbol and save it when asked to
+    if trace_level >= TRACE_SYMBOLS:
+        for line in iter_json_lines(parse_tree.to_dict()):
+            trace_hook(line)
+    if tree_output is not None:
+        with stats.phase('dump parse tree'):
+            dump_parse_tree(parse_tree, tree_output, tree_format)
+
+    if backend == 'mido':
+        mido = optional_import('mido')
+        if mido is None:
+            raise ImportError("The 'mido' backend needs the mido package.")
         # MIDI File Setup
-        mid = MidiFile()
-        track = MidiTrack()
+        mid = mido.MidiFile()
+        track = mido.MidiTrack()
         mid.tracks.append(track)
         # Process the parse tree to generate MIDI
-        process_parse_tree(parse_tree, track, logger)
+        with stats.phase('process_parse_tree'):
+            process_parse_tree(parse_tree, track, logger)
+        stats.count('midi events', len(track))
         # Save the MIDI file with the specified name
-        mid.save(output_file)
+        with stats.phase('save'):
+            mid.save(output_file)
+    else:
+        with stats.phase('build events'):
+            grid = Grid.from_parse_tree(parse_tree)
+            if logger:
+                for section in grid.sections():
+                    log_section(section, logger)
+            statuses, notes, times, _ = build_events(grid.masks, grid.section_starts)
+        stats.count('midi events', len(statuses))
+        with stats.phase('save'):
+            write_midi(statuses, notes, times, output_file)
+    return stats
+
+
+def text_to_midi2(text, output_file="result_FIX.mid", logger=None, stats=None, profile=False, backend='native',
+                  tree_output=None, tree_format='jsonl', cache=None):
+    """
+    Converts text to a MIDI file. Pass a PipelineStats as stats to collect phase
+    timings and counters, or profile=True to send them to the logger.
+    backend='mido' builds the file from mido Messages instead of the native writer.
+    The parse tree is only saved when tree_output (a path or text file object) is given.
+    Pass a ConversionCache as cache to reuse results of earlier conversions.
+    """
+    try:
+        stats = convert_text_to_midi(text, output_file, logger, stats, backend, tree_output, tree_format, cache)
         if logger:
             logger(f"MIDI file generated successfully as '{output_file}'.")
+        if profile:
+            log_stats(stats, logger)
     except ValueError as ve:
         if logger:
             logger(str(ve), is_error=True)
@@ -251,39 +2032,22 @@ def text_to_midi2(text, output_file="result_FIX.mid", logger=None):
             print(f"\033[91mAn unexpected error occurred: {e}\033[0m")  # Print unexpected errors in red text
 
 
-def text_to_array(text, logger=None):
+def text_to_array(text, logger=None, stats=None, profile=False, cache=None):
+    if stats is None:
+        stats = PipelineStats()
     try:
-        tokens = tokenize(text)
-        parse_tree = parse_Start(tokens)
-
-        all_sections = []
-        current_section = [[] for _ in range(5)]
-
-        # recursive function to convert parse tree to result
-        def extract_patterns(node, patterns=None):
-            if patterns is None:
-                patterns = []
-
-            if node['type'] in ['SingleNote', 'DoubleNote', 'TripleNote', 'QuadNote', 'QuintNote']:
-                patterns.append(node['value'])
-            elif node['type'] == 'NewColumn':
-                patterns.append('newline')
-            elif 'elements' in node:
-                for child in node['elements']:
-                    extract_patterns(child, patterns)
-            return patterns
-
-        result = extract_patterns(parse_tree)
-
-        for item in result:
-            if item == 'newline':
-                all_sections += current_section
-                current_section = [[] for _ in range(5)]
-            else:
-                for i in range(5):
-                    current_section[i].append(item[i])
-        if current_section:
-            all_sections += current_section
+        if has_run_syntax(text):
+            with stats.phase('expand runs'):
+                text = expand_runs(text)
+        if cache is not None:
+            all_sections = cached_grid(text, cache, stats).to_rows()
+        else:
+            parse_tree = run_phases(text, stats)
+
+            with stats.phase('build grid'):
+                all_sections = Grid.from_parse_tree(parse_tree).to_rows()
+        if profile:
+            log_stats(stats, logger)
         return all_sections
     except ValueError as ve:
         raise ve
@@ -291,6 +2055,835 @@ def text_to_array(text, logger=None):
         raise f"An unexpected error occurred: {e}"
 
 
+# Incremental editing: the text is kept split at its 9p separators with the masks of every
+# section, so an edit only re-tokenizes the sections it touches. Every token is a digit
+# followed by a letter, so a 9p that is not on a token boundary always makes the input
+# invalid and splitting on the substring gives the same sections as the parser.
+SEPARATOR = '9p'
+
+
+def lex_section(section):
+    """
+    Returns (mask bytes, None) for a section, or (None, TokenizeError) if it does not tokenize.
+    """
+    try:
+        return bytes(tokenize_ids(section)).translate(mask_table), None
+    except TokenizeError as e:
+        return None, e
+
+
+class PrefixSums:
+    """
+    Fenwick tree over a list of integers: point updates and prefix sums in O(log n).
+    """
+    def __init__(self, values):
+        self.tree = [0] + list(values)
+        size = len(self.tree)
+        for index in range(1, size):
+            parent = index + (index & -index)
+            if parent < size:
+                self.tree[parent] += self.tree[index]
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def add(self, index, delta):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        """
+        Returns the sum of the first index values.
+        """
+        total = 0
+        while index:
+            total += self.tree[index]
+            index &= index - 1
+        return total
+
+    def find(self, total):
+        """
+        Returns the last index whose prefix sum is at most total.
+        """
+        index = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            if index + step < len(self.tree) and self.tree[index + step] <= total:
+                index += step
+                total -= self.tree[index]
+            step >>= 1
+        return min(index, len(self) - 1)
+
+
+class IncrementalDocument:
+    """
+    Input text held as a list of sections, each with its mask bytes (None if the
+    section does not tokenize) and the TokenizeError it raised. The section offsets,
+    text length, error count and longest section are kept up to date by every edit.
+    """
+    def __init__(self, text=''):
+        self.set_text(text)
+
+    def set_text(self, text):
+        self.sections = text.split(SEPARATOR)
+        self.masks = []
+        self.errors = []
+        for section in self.sections:
+            masks, error = lex_section(section)
+            self.masks.append(masks)
+            self.errors.append(error)
+        self.offsets = PrefixSums(len(section) + len(SEPARATOR) for section in self.sections)
+        self.length = len(text)
+        self.error_count = sum(error is not None for error in self.errors)
+        self.empty_count = self.sections.count('')
+        # How many sections have each number of cells, for the longest section
+        self.cell_counts = Counter(len(masks) for masks in self.masks if masks is not None)
+        self.max_cells = max(self.cell_counts, default=0)
+
+    @property
+    def text(self):
+        return SEPARATOR.join(self.sections)
+
+    def __len__(self):
+        return self.length
+
+    def section_starts(self):
+        """
+        Returns the text offset of every section.
+        """
+        separator_length = len(SEPARATOR)
+        return [0] + list(accumulate(len(section) + separator_length for section in self.sections[:-1]))
+
+    def count_sections(self, first, last, sign):
+        for section, masks, error in zip(self.sections[first:last], self.masks[first:last], self.errors[first:last]):
+            self.error_count += sign * (error is not None)
+            self.empty_count += sign * (not section)
+            if masks is not None:
+                self.cell_counts[len(masks)] += sign
+
+    def apply_edit(self, start, end, replacement):
+        """
+        Replaces text[start:end] with replacement and re-lexes only the affected sections.
+        Returns (first, removed, added): sections[first:first + removed] were replaced
+        by the added new sections.
+        """
+        # A separator can be created or destroyed by the characters on either side of the edit
+        first = self.offsets.find(max(start - 1, 0))
+        last = self.offsets.find(min(end + 1, self.length))
+        region_start = self.offsets.prefix(first)
+        region_end = self.offsets.prefix(last) + len(self.sections[last])
+        if end > region_end:
+            last += 1
+            region_end = self.offsets.prefix(last) + len(self.sections[last])
+
+        region = SEPARATOR.join(self.sections[first:last + 1])
+        region = region[:start - region_start] + replacement + region[end - region_start:]
+        new_sections = region.split(SEPARATOR)
+        lexed = [lex_section(section) for section in new_sections]
+
+        self.count_sections(first, last + 1, -1)
+        removed = last + 1 - first
+        if len(new_sections) == removed:
+            for index, section in enumerate(new_sections, first):
+                self.offsets.add(index, len(section) - len(self.sections[index]))
+        self.sections[first:last + 1] = new_sections
+        self.masks[first:last + 1] = [masks for masks, _ in lexed]
+        self.errors[first:last + 1] = [error for _, error in lexed]
+        if len(new_sections) != removed:
+            # Inserting or removing a separator shifts every later index, so the tree is rebuilt
+            self.offsets = PrefixSums(len(section) + len(SEPARATOR) for section in self.sections)
+        self.count_sections(first, first + len(new_sections), 1)
+        self.length += len(replacement) - (end - start)
+
+        if self.max_cells not in self.cell_counts or self.cell_counts[self.max_cells] <= 0:
+            self.cell_counts = +self.cell_counts
+            self.max_cells = max(self.cell_counts, default=0)
+        else:
+            self.max_cells = max(self.max_cells, max((len(masks) for masks, _ in lexed if masks is not None),
+                                                     default=0))
+        return first, removed, len(new_sections)
+
+    def check(self):
+        """
+        Raises the TokenizeError or ParseError the full parser would raise for the text.
+        """
+        if self.error_count:
+            text = self.text
+            if has_run_syntax(text):
+                # Report mistakes in the repeats where they are before refusing the text
+                check_runs(parse_runs(text))
+                raise ValueError("Repeat syntax cannot be edited incrementally, expand it with expand_runs first.")
+            # Misaligned sections shift the tokens after them, so let the full tokenizer find the offset
+            tokenize_ids(text)
+        if not self.empty_count:
+            return
+        token_index = 0
+        for index, section in enumerate(self.sections):
+            if not section:
+                token = SEPARATOR if index + 1 < len(self.sections) else None
+                raise_parse_error('Start' if index == 0 else 'Pattern', token, token_index)
+            token_index += len(section) // token_max_length + 1
+
+    def grid(self):
+        """
+        Returns the Grid of the whole text, raising if the text is invalid.
+        """
+        self.check()
+        section_starts = array('Q', [0])
+        section_starts.extend(accumulate(len(masks) for masks in self.masks[:-1]))
+        return Grid(array('B', b''.join(self.masks)), section_starts)
+
+    def section_rows(self, index):
+        """
+        Returns the row_count lists of 0/1 of one section, or None if it does not tokenize.
+        """
+        masks = self.masks[index]
+        if masks is None:
+            return None
+        return section_rows(masks)
+
+
+# Preview rasterizer: screen column c shows row c % row_count of section c // row_count
+# and screen row j the j-th pattern of that section
+CELL_ABSENT, CELL_EMPTY, CELL_FILLED = 0, 1, 2
+
+
+def render_preview_ppm(section_masks, first_column, column_count, first_cell, cell_count, box_size):
+    """
+    Rasterizes a window of the preview as a binary PPM image. Filled cells are black,
+    empty cells white with a black top and left border, and cells past the end of a
+    section (or in a section given as None) are left white.
+    """
+    black, white = b'\x00\x00\x00', b'\xff\xff\xff'
+    body_segments = (white * box_size, black + white * (box_size - 1), black * box_size)
+    border_segments = (white * box_size, black * box_size, black * box_size)
+
+    columns = []
+    for column in range(first_column, first_column + column_count):
+        section, row = divmod(column, row_count)
+        columns.append((section_masks[section] if section < len(section_masks) else None, 1 << row))
+
+    lines = []
+    for cell in range(first_cell, first_cell + cell_count):
+        states = [
+            CELL_ABSENT if masks is None or cell >= len(masks) else (CELL_FILLED if masks[cell] & bit else CELL_EMPTY)
+            for masks, bit in columns
+        ]
+        lines.append(b''.join(map(border_segments.__getitem__, states)))
+        lines.append(b''.join(map(body_segments.__getitem__, states)) * (box_size - 1))
+    header = b'P6 %d %d 255\n' % (column_count * box_size, cell_count * box_size)
+    return header + b''.join(lines)
+
+
+# Image encoder, the inverse of text_to_array: every band of row_count image rows becomes
+# a section and every column of a band the pattern token of its mask. Dark pixels (ink)
+# are filled cells. Reads PBM, PGM and grayscale PNG natively, other formats through Pillow.
+mask_tokens = [None] * (1 << row_count)  # mask -> first pattern token with that mask
+for token_id, mask in enumerate(default_tables.token_masks):
+    if mask is not None and mask_tokens[mask] is None:
+        mask_tokens[mask] = token_names[token_id]
+PNM_EXTENSIONS = ('.pbm', '.pgm', '.pnm')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+pnm_number_pattern = re.compile(rb'(?:\s|#[^\n]*\n?)*(\d+)')
+
+
+def read_pnm_header(data, fields):
+    """
+    Returns the header numbers of a PNM file (after the magic number) and the offset of
+    the raster, skipping whitespace and comments.
+    """
+    values = []
+    position = 2
+    while len(values) < fields:
+        match = pnm_number_pattern.match(data, position)
+        if match is None:
+            raise ValueError(f"Invalid PNM header at byte {position}.")
+        values.append(int(match.group(1)))
+        position = match.end()
+    return values, position + 1  # a single whitespace character ends the header
+
+
+def gray_to_bitmap(data, width, height, maxval, ink_is_low=True):
+    """
+    Thresholds 8 or 16-bit big-endian gray samples at half of maxval. Returns a 2D NumPy
+    array when NumPy is installed and a list of rows of 0/1 otherwise.
+    """
+    wide = maxval > 255
+    np = optional_import('numpy')
+    if np is not None:
+        samples = np.frombuffer(data, dtype='>u2' if wide else np.uint8, count=width * height)
+        filled = samples < maxval / 2 if ink_is_low else samples >= maxval / 2
+        return filled.reshape(height, width).astype(np.uint8)
+    if wide:
+        samples = struct.unpack(f'>{width * height}H', data[:width * height * 2])
+    else:
+        samples = data[:width * height]
+    if ink_is_low:
+        bits = [1 if value < maxval / 2 else 0 for value in samples]
+    else:
+        bits = [1 if value >= maxval / 2 else 0 for value in samples]
+    return [bits[top:top + width] for top in range(0, width * height, width)]
+
+
+def read_pnm(data):
+    """
+    Decodes a PBM (P1, P4) or PGM (P2, P5) image into a bitmap, see gray_to_bitmap.
+    """
+    np = optional_import('numpy')
+    magic = data[:2]
+    if magic in (b'P1', b'P4'):
+        (width, height), start = read_pnm_header(data, 2)
+        if magic == b'P1':
+            # Plain PBM pixels are single digits that need not be separated
+            bits = bytes(re.sub(rb'#[^\n]*|\s', b'', data[start - 1:])[:width * height])
+            return gray_to_bitmap(bits.translate(bytes.maketrans(b'01', b'\x00\x01')), width, height, 1, False)
+        stride = (width + 7) // 8
+        if np is not None:
+            packed = np.frombuffer(data, np.uint8, count=stride * height, offset=start).reshape(height, stride)
+            return np.unpackbits(packed, axis=1)[:, :width]
+        return [
+            [(data[start + row * stride + column // 8] >> (7 - column % 8)) & 1 for column in range(width)]
+            for row in range(height)
+        ]
+    if magic in (b'P2', b'P5'):
+        (width, height, maxval), start = read_pnm_header(data, 3)
+        if magic == b'P2':
+            values = [int(value) for value in re.sub(rb'#[^\n]*', b'', data[start - 1:]).split()[:width * height]]
+            data = struct.pack(f'>{len(values)}H', *values) if maxval > 255 else bytes(values)
+            return gray_to_bitmap(data, width, height, maxval)
+        return gray_to_bitmap(data[start:], width, height, maxval)
+    raise ValueError("Only PBM (P1, P4) and PGM (P2, P5) images can be read without Pillow.")
+
+
+def unfilter_png(data, height, stride, pixel_size):
+    """
+    Undoes the per-row PNG filters of decompressed image data and returns the raw rows
+    joined together.
+    """
+    rows = []
+    previous = bytearray(stride)
+    for top in range(0, height * (stride + 1), stride + 1):
+        kind = data[top]
+        row = bytearray(data[top + 1:top + 1 + stride])
+        if len(row) < stride:
+            raise ValueError("Truncated PNG image data.")
+        if kind == 1:  # Sub
+            for i in range(pixel_size, stride):
+                row[i] = (row[i] + row[i - pixel_size]) & 0xff
+        elif kind == 2:  # Up
+            row = bytearray((a + b) & 0xff for a, b in zip(row, previous))
+        elif kind == 3:  # Average
+            for i in range(stride):
+                left = row[i - pixel_size] if i >= pixel_size else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+        elif kind == 4:  # Paeth
+            for i in range(stride):
+                left = row[i - pixel_size] if i >= pixel_size else 0
+                upper_left = previous[i - pixel_size] if i >= pixel_size else 0
+                estimate = left + previous[i] - upper_left
+                distances = abs(estimate - left), abs(estimate - previous[i]), abs(estimate - upper_left)
+                if distances[0] <= distances[1] and distances[0] <= distances[2]:
+                    predictor = left
+                elif distances[1] <= distances[2]:
+                    predictor = previous[i]
+                else:
+                    predictor = upper_left
+                row[i] = (row[i] + predictor) & 0xff
+        elif kind:
+            raise ValueError(f"Invalid PNG filter type {kind}.")
+        rows.append(row)
+        previous = row
+    return b''.join(rows)
+
+
+def read_png(data):
+    """
+    Decodes a non-interlaced grayscale PNG (any bit depth, with or without alpha, which
+    is ignored) into a bitmap, see gray_to_bitmap.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG file.")
+    header = None
+    compressed = []
+    position = len(PNG_SIGNATURE)
+    while position + 8 <= len(data):
+        length, kind = struct.unpack_from('>L4s', data, position)
+        chunk = data[position + 8:position + 8 + length]
+        if len(chunk) < length:
+            raise ValueError(f"Truncated PNG chunk at byte {position}.")
+        if kind == b'IHDR':
+            header = struct.unpack('>LLBBBBB', chunk[:13])
+        elif kind == b'IDAT':
+            compressed.append(chunk)
+        elif kind == b'IEND':
+            break
+        position += 12 + length
+    if header is None:
+        raise ValueError("Missing PNG header chunk.")
+    width, height, depth, color_type, _, _, interlace = header
+    if color_type not in (0, 4) or interlace:
+        raise ValueError("Only non-interlaced grayscale PNG images can be read without Pillow.")
+    channels = 2 if color_type == 4 else 1
+    stride = (width * channels * depth + 7) // 8
+    try:
+        raw = zlib.decompress(b''.join(compressed))
+    except zlib.error as e:
+        raise ValueError(f"Invalid PNG image data: {e}")
+    raw = unfilter_png(raw, height, stride, max(channels * depth // 8, 1))
+
+    sample_size = depth // 8
+    if channels == 2:
+        # Keep the gray sample of every pixel
+        if sample_size == 1:
+            raw = raw[::2]
+        else:
+            raw = b''.join(raw[i:i + sample_size] for i in range(0, len(raw), 2 * sample_size))
+    elif depth < 8:
+        # Unpack 1, 2 or 4-bit samples to a byte each, rows start on a byte boundary
+        rows = []
+        for top in range(0, len(raw), stride):
+            bits = int.from_bytes(raw[top:top + stride], 'big') >> (stride * 8 - width * depth)
+            rows.append(bytes((bits >> (depth * (width - 1 - column))) & ((1 << depth) - 1)
+                              for column in range(width)))
+        raw = b''.join(rows)
+    return gray_to_bitmap(raw, width, height, (1 << depth) - 1)
+
+
+def load_image(path):
+    """
+    Loads an image file as a bitmap of filled (dark) cells. PBM and PGM are read natively,
+    and so is grayscale PNG when Pillow is not installed. Other formats need Pillow.
+    """
+    if path.lower().endswith(PNM_EXTENSIONS):
+        with open(path, 'rb') as f:
+            return read_pnm(f.read())
+    Image = optional_import('PIL.Image')
+    if Image is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data.startswith(PNG_SIGNATURE):
+            return read_png(data)
+        raise ImportError("Reading this image format needs the Pillow package, PBM, PGM and grayscale PNG work "
+                          "without it.")
+    with Image.open(path) as image:
+        gray = image.convert('L')
+        return gray_to_bitmap(gray.tobytes(), gray.width, gray.height, 255)
+
+
+def image_to_text(image):
+    """
+    Encodes a bitmap (rows of 0/1 or a 2D NumPy array, nonzero cells are filled) as input
+    text, so that text_to_array(image_to_text(image)) gives the image back. Blank rows are
+    added at the bottom when the height is not a multiple of row_count.
+    """
+    np = optional_import('numpy')
+    if np is not None:
+        filled = np.asarray(image) != 0
+        if filled.ndim != 2 or not filled.size:
+            raise ValueError("The image must be a non-empty 2D bitmap.")
+        height, width = filled.shape
+        if height % row_count:
+            filled = np.vstack([filled, np.zeros((row_count - height % row_count, width), dtype=bool)])
+        # masks[section, column] = sum of row bits, then every mask is looked up as 2 token bytes
+        bands = filled.reshape(-1, row_count, width).astype(np.uint8)
+        masks = (bands << np.arange(row_count, dtype=np.uint8)[:, None]).sum(axis=1, dtype=np.uint8)
+        token_bytes = np.frombuffer(''.join(mask_tokens).encode('ascii'), dtype=np.uint8).reshape(-1, token_max_length)
+        text = np.empty((len(masks), (width + 1) * token_max_length), dtype=np.uint8)
+        text[:, :-token_max_length] = token_bytes[masks].reshape(len(masks), -1)
+        text[:, -token_max_length:] = np.frombuffer(SEPARATOR.encode('ascii'), dtype=np.uint8)
+        return text.tobytes()[:-token_max_length].decode('ascii')
+
+    rows = [[1 if value else 0 for value in row] for row in image]
+    if not rows or not rows[0] or any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("The image must be a non-empty 2D bitmap.")
+    rows += [[0] * len(rows[0])] * (-len(rows) % row_count)
+    sections = []
+    for top in range(0, len(rows), row_count):
+        masks = [pattern_to_mask(column) for column in zip(*rows[top:top + row_count])]
+        sections.append(''.join(map(mask_tokens.__getitem__, masks)))
+    return SEPARATOR.join(sections)
+
+
+# MIDI decoder, the inverse of the MIDI writer: the track is walked event by event straight
+# from the file bytes. The time of every note_on (in units of 100 ticks) is its step, so
+# step // row_count is its section and step % row_count its row, and the column of a note
+# is starting_pitch - pitch. The section length (and so starting_pitch) is not stored in
+# the file; the shortest one that fits every note is used, which re-encodes to the same
+# bytes. Trailing silent sections leave no trace and are not restored.
+STEP_TICKS = 100
+
+
+def raise_truncated(position):
+    raise ValueError(f"Truncated MIDI file: data ends at byte {position}.")
+
+
+def iter_midi_notes(data):
+    """
+    Yields (absolute time, status, note) for every note event of a single track MIDI file
+    given as bytes, an mmap or another buffer. Note on with velocity 0 counts as note off.
+    """
+    view = memoryview(data).cast('B')
+    if bytes(view[:4]) != b'MThd':
+        raise ValueError("Not a MIDI file.")
+    if len(view) < 14:
+        raise_truncated(len(view))
+    header_length, _, track_count = struct.unpack_from('>LHH', view, 4)
+    if track_count != 1:
+        raise ValueError("Only single track MIDI files can be decoded.")
+    position = 8 + header_length
+    if position + 8 > len(view):
+        raise_truncated(len(view))
+    if bytes(view[position:position + 4]) != b'MTrk':
+        raise ValueError(f"Missing track chunk at byte {position}.")
+    track_length, = struct.unpack_from('>L', view, position + 4)
+    position += 8
+    end = position + track_length
+    if end > len(view):
+        raise_truncated(len(view))
+    time = 0
+    running_status = None
+    while position < end:
+        delta = 0
+        while True:
+            if position >= end:
+                raise_truncated(position)
+            byte = view[position]
+            position += 1
+            delta = (delta << 7) | (byte & 0x7f)
+            if byte < 0x80:
+                break
+        time += delta
+        if position >= end:
+            raise_truncated(position)
+        status = view[position]
+        if status >= 0x80:
+            position += 1
+            if status < 0xf0:
+                running_status = status
+        elif running_status is None:
+            raise ValueError(f"Data byte without a status at byte {position}.")
+        else:
+            status = running_status
+
+        if status in (0xff, 0xf0, 0xf7):  # meta and sysex events carry a length
+            if status == 0xff:
+                position += 1
+            length = 0
+            while True:
+                if position >= end:
+                    raise_truncated(position)
+                byte = view[position]
+                position += 1
+                length = (length << 7) | (byte & 0x7f)
+                if byte < 0x80:
+                    break
+            position += length
+            if position > end:
+                raise_truncated(end)
+            continue
+        kind = status & 0xf0
+        if kind in (0xc0, 0xd0):
+            position += 1
+            if position > end:
+                raise_truncated(end)
+            continue
+        if position + 2 > end:
+            raise_truncated(end)
+        note, velocity = view[position], view[position + 1]
+        position += 2
+        if kind == NOTE_ON and velocity:
+            yield time, NOTE_ON, note
+        elif kind in (NOTE_ON, NOTE_OFF):
+            yield time, NOTE_OFF, note
+
+
+def section_from_notes(notes):
+    """
+    Returns the masks of the shortest section whose starting_pitch puts every (row, pitch)
+    note in a column of the section.
+    """
+    if not notes:
+        return [0]
+    highest = max(pitch for _, pitch in notes)
+    lowest = min(pitch for _, pitch in notes)
+    length = 1
+    # starting_pitch = ceil(60 + n / 2) grows by one for every two columns, so this ends
+    while True:
+        starting_pitch = 60 + (length + 1) // 2
+        if starting_pitch - highest >= 0 and starting_pitch - lowest < length:
+            break
+        length += 1
+    masks = [0] * length
+    for row, pitch in notes:
+        masks[starting_pitch - pitch] |= 1 << row
+    return masks
+
+
+def iter_midi_sections(src):
+    """
+    Yields the masks of every section of a MIDI file written by this converter, one
+    section at a time. src can be a path (read through mmap), a binary file object or
+    a bytes-like object. Raises ValueError if the events do not follow the 100 tick grid.
+    """
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from iter_midi_sections(mapped)
+        return
+    if hasattr(src, 'read'):
+        src = src.read()
+
+    section = 0
+    notes = []  # (row, pitch) of the current section
+    step_time = None
+    playing = False  # between the note_on and note_off events of a step
+    for time, status, note in iter_midi_notes(src):
+        if status == NOTE_ON:
+            if not playing:
+                if time % STEP_TICKS:
+                    raise ValueError(f"Note on at tick {time} is not on the {STEP_TICKS} tick grid.")
+                step_time = time
+                playing = True
+            elif time != step_time:
+                raise ValueError(f"Note on at tick {time} does not start with the rest of its step.")
+            step_section, row = divmod(time // STEP_TICKS, row_count)
+            while section < step_section:
+                yield section_from_notes(notes)
+                notes = []
+                section += 1
+            notes.append((row, note))
+        else:
+            if step_time is None or time != step_time + STEP_TICKS:
+                raise ValueError(f"Note off at tick {time} does not end a {STEP_TICKS} tick step.")
+            playing = False
+    yield section_from_notes(notes)
+
+
+def iter_midi_text(src):
+    """
+    Yields the canonical input text of a MIDI file section by section, see iter_midi_sections.
+    """
+    for index, masks in enumerate(iter_midi_sections(src)):
+        if index:
+            yield SEPARATOR
+        yield ''.join(map(mask_tokens.__getitem__, masks))
+
+
+def midi_to_text(src):
+    return ''.join(iter_midi_text(src))
+
+
+def verify_midi(path):
+    """
+    Decodes a MIDI file and encodes the text again. Returns the text and whether the
+    encoded bytes match the file.
+    """
+    text = midi_to_text(path)
+    grid = Grid.from_token_ids(tokenize_ids(text))
+    statuses, notes, times, _ = build_events(grid.masks, grid.section_starts)
+    with open(path, 'rb') as f:
+        return text, write_midi(statuses, notes, times) == f.read()
+
+
+# Headless batch conversion, run with: python -m logic batch INPUT -o OUTPUT_DIR
+def iter_batch_inputs(source, field='text', name_field=None):
+    """
+    Yields (name, text) pairs from a directory of .txt files, a JSON Lines file
+    (text taken from `field`) or a plain text file with one input per line.
+    """
+    if os.path.isdir(source):
+        for file_name in sorted(os.listdir(source)):
+            if file_name.endswith('.txt'):
+                with open(os.path.join(source, file_name)) as f:
+                    yield os.path.splitext(file_name)[0], f.read().strip()
+        return
+
+    with open(source) as f:
+        if source.endswith('.jsonl'):
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                name_keys = [name_field] if name_field else ['name', 'id', 'request_id']
+                name = next((str(record[key]) for key in name_keys if key in record), f"line-{line_number}")
+                yield name, str(record.get(field, '')).strip()
+        else:
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    yield f"line-{line_number}", line.strip()
+
+
+batch_caches = {}  # cache directory -> ConversionCache of this worker process
+
+
+def convert_batch_item(item):
+    """
+    Converts one (name, text, output_file, cache_dir) batch item. Runs in a worker process
+    and returns a summary dict instead of raising.
+    """
+    name, text, output_file, cache_dir = item
+    start = time.perf_counter()
+    result = {'name': name, 'output': output_file, 'error': None}
+    try:
+        cache = None
+        if cache_dir:
+            if cache_dir not in batch_caches:
+                batch_caches[cache_dir] = ConversionCache(directory=cache_dir)
+            cache = batch_caches[cache_dir]
+        stats = convert_text_to_midi(text, output_file, cache=cache)
+        result['tokens'] = stats.counters.get('tokens', 0)
+        result['midi events'] = stats.counters.get('midi events', 0)
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def batch_file_name(name, used):
+    """
+    Returns a file name (without extension) for a batch item name that is safe for the
+    file system and not in used, ignoring case, and adds it to used. Names that end up
+    equal get a -2, -3... suffix so no output overwrites another.
+    """
+    base = re.sub(r'[^\w.-]', '_', name)
+    file_name = base
+    suffix = 1
+    while file_name.lower() in used:
+        suffix += 1
+        file_name = f"{base}-{suffix}"
+    used.add(file_name.lower())
+    return file_name
+
+
+def run_batch(source, output_dir, workers=None, chunksize=1, field='text', name_field=None, cache_dir=None):
+    """
+    Converts every input of source to output_dir/<name>.mid across a process pool and
+    returns a summary with per item timings and errors. With cache_dir, results are
+    shared between workers and runs through an on-disk ConversionCache.
+    """
+    if workers is not None and workers < 1:
+        raise ValueError("workers must be at least 1.")
+    os.makedirs(output_dir, exist_ok=True)
+    used = set()  # output file names taken so far
+    items = (
+        (name, text, os.path.join(output_dir, batch_file_name(name, used) + '.mid'), cache_dir)
+        for name, text in iter_batch_inputs(source, field, name_field)
+    )
+    start = time.perf_counter()
+    if workers == 1:
+        results = list(map(convert_batch_item, items))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(convert_batch_item, items, chunksize=chunksize))
+    failed = sum(1 for result in results if result['error'])
+    return {
+        'workers': workers or os.cpu_count(),
+        'seconds': time.perf_counter() - start,
+        'converted': len(results) - failed,
+        'failed': failed,
+        'items': results,
+    }
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m logic', description="Text to MIDI converter")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    batch = commands.add_parser('batch', help="convert many inputs without the GUI")
+    batch.add_argument('source', help="directory of .txt files, .jsonl file or text file with one input per line")
+    batch.add_argument('-o', '--output-dir', default='midi_output')
+    batch.add_argument('-w', '--workers', type=positive_int, default=None, help="worker processes (default: CPU count)")
+    batch.add_argument('-c', '--chunksize', type=positive_int, default=1, help="inputs sent to a worker at a time")
+    batch.add_argument('--field', default='text', help="JSON Lines field holding the input text")
+    batch.add_argument('--name-field', default=None, help="JSON Lines field used as the output file name")
+    batch.add_argument('--summary', default=None, help="summary JSON path (default: OUTPUT_DIR/summary.json)")
+    batch.add_argument('--cache-dir', default=None, help="directory of cached conversions shared between runs")
+
+    convert = commands.add_parser('convert', help="convert one long input, compiling its sections in parallel")
+    convert.add_argument('input', help="text file")
+    convert.add_argument('-o', '--output', default=None, help="MIDI file to write (default: INPUT with .mid)")
+    convert.add_argument('-w', '--workers', type=positive_int, default=None, help="worker processes (default: CPU count)")
+    convert.add_argument('--chunk-tokens', type=positive_int, default=None, help="tokens per chunk handed to a worker")
+
+    encode = commands.add_parser('encode', help="encode an image as input text")
+    encode.add_argument('image', help="PBM, PGM or grayscale PNG image (other formats need Pillow), "
+                                      "dark pixels are notes")
+    encode.add_argument('-o', '--output', default=None, help="text file to write (default: print it)")
+
+    decode = commands.add_parser('decode', help="decode MIDI files written by the converter back to text")
+    decode.add_argument('files', nargs='+', help="MIDI files")
+    decode.add_argument('-o', '--output-dir', default=None, help="write FILE.txt here (default: print the text)")
+    decode.add_argument('--verify', action='store_true', help="only check that the text encodes to the same bytes")
+
+    args = parser.parse_args(argv)
+    if args.command == 'decode':
+        failed = 0
+        for path in args.files:
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                if args.verify:
+                    _, same = verify_midi(path)
+                    if not same:
+                        raise ValueError("the decoded text encodes to different bytes")
+                    continue
+                text = midi_to_text(path)
+            except (OSError, ValueError) as e:
+                failed += 1
+                print(f"\033[91m{path}: {e}\033[0m")
+                continue
+            if args.output_dir is None:
+                print(text)
+            else:
+                os.makedirs(args.output_dir, exist_ok=True)
+                with open(os.path.join(args.output_dir, name + '.txt'), 'w') as f:
+                    f.write(text)
+        if args.verify:
+            print(f"{len(args.files) - failed} of {len(args.files)} files round-trip.")
+        return 1 if failed else 0
+    if args.command == 'convert':
+        with open(args.input) as f:
+            text = f.read().strip()
+        output = args.output or os.path.splitext(args.input)[0] + '.mid'
+        stats = PipelineStats()
+        try:
+            parallel_text_to_midi(text, output, args.workers, args.chunk_tokens, stats)
+        except ValueError as e:
+            print(f"\033[91m{args.input}: {e}\033[0m")
+            return 1
+        log_stats(stats)
+        return 0
+    if args.command == 'encode':
+        text = image_to_text(load_image(args.image))
+        if args.output is None:
+            print(text)
+        else:
+            with open(args.output, 'w') as f:
+                f.write(text)
+        return 0
+    if args.command == 'batch':
+        summary = run_batch(args.source, args.output_dir, args.workers, args.chunksize, args.field, args.name_field,
+                            args.cache_dir)
+        summary_path = args.summary or os.path.join(args.output_dir, 'summary.json')
+        with open(summary_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        for result in summary['items']:
+            if result['error']:
+                print(f"\033[91m{result['name']}: {result['error']}\033[0m")
+        print(f"Converted {summary['converted']} of {len(summary['items'])} inputs in "
+              f"{summary['seconds']:.2f} s, summary written to '{summary_path}'.")
+        return 1 if summary['failed'] else 0
+
+
 # # Example usage:
 # # Test Case 1: Single Token
 # print("=== Test Case 1: simple ===")
@@ -339,3 +2932,7 @@ def text_to_array(text, logger=None):
 #
 # # Process the parse tree and generate a MIDI file
 # text_to_midi2(text, output_file="result_FIX_SANS.mid")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
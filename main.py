@@ -1,58 +1,124 @@
+import io
+import queue
+import threading
 import tkinter as tk
-from tkinter import messagebox
-from logic import grammar, text_to_midi2, text_to_array
+from tkinter import ttk
+from logic import (grammar, stream_text_to_midi, ConversionCache, ConversionCancelled, IncrementalDocument,
+                   row_count, render_preview_ppm, has_run_syntax, run_text_to_midi, expand_runs)
+
+# Log, progress and completion events from the conversion thread, drained on the Tk thread
+event_queue = queue.Queue()
+DRAIN_INTERVAL_MS = 50
+MAX_EVENTS_PER_DRAIN = 1000
+PROGRESS_CHUNK_SIZE = 1 << 14
+cancel_event = None
+
+# Reuse results when the same text (or the same sections) is previewed or converted again
+conversion_cache = ConversionCache()
+
+# The input text split into sections, updated on every edit for the live preview
+live_document = IncrementalDocument()
+live_preview_update = None
+
+# Symbol legend layout in pixels
+LEGEND_PADDING = 10
+LEGEND_COLUMN_GAP = 40
+LEGEND_ROW_HEIGHT = 24
+LEGEND_ROW_GAP = 6
+LEGEND_BOX_SIZE = 16
+LEGEND_BOX_GAP = 2
 
 
 def create_visual_grid(frame):
     """
     Displays all the symbols and their visual box representation in a horizontal layout.
+    Everything is drawn on a single canvas, a widget per box made the window slow to appear.
     """
     # Clear the frame first
     for widget in frame.winfo_children():
         widget.destroy()
 
-    column = 0  # Start placing sections from the first column
+    canvas = tk.Canvas(frame, highlightthickness=0)
+    left = LEGEND_PADDING  # Start placing sections from the left edge
+    bottom = 0
     for category, tokens in grammar.items():
-        if isinstance(tokens, dict):  # Only process tokens that have patterns
-            # Create a frame for each section
-            section_frame = tk.Frame(frame)
-            section_frame.grid(row=0, column=column, padx=20, pady=10)  # Place each section in a new column
-
-            # Display the category name
-            tk.Label(section_frame, text=category, font=("Arial", 14, "bold")).pack(anchor="w", pady=5)
-
-            # Display symbols and their visual patterns
-            for symbol, pattern in tokens.items():
-                row_frame = tk.Frame(section_frame)
-                row_frame.pack(anchor="w", pady=2)
-
-                # Display the symbol
-                tk.Label(row_frame, text=f"{symbol}:", font=("Arial", 12)).pack(side="left", padx=5)
+        if not isinstance(tokens, dict):  # Only process tokens that have patterns
+            continue
+
+        # Display the category name
+        title = canvas.create_text(left, LEGEND_PADDING, text=category, font=("Arial", 14, "bold"), anchor="nw")
+        right = canvas.bbox(title)[2]
+        top = canvas.bbox(title)[3] + LEGEND_ROW_GAP
+
+        # Display the symbols, then their visual patterns lined up after the widest one
+        labels = [
+            canvas.create_text(left, top + row * LEGEND_ROW_HEIGHT + LEGEND_ROW_HEIGHT // 2, text=f"{symbol}:",
+                               font=("Arial", 12), anchor="w")
+            for row, symbol in enumerate(tokens)
+        ]
+        boxes_left = max(canvas.bbox(label)[2] for label in labels) + LEGEND_ROW_GAP
+        for row, pattern in enumerate(tokens.values()):
+            box_top = top + row * LEGEND_ROW_HEIGHT + (LEGEND_ROW_HEIGHT - LEGEND_BOX_SIZE) // 2
+            for index, value in enumerate(pattern):
+                box_left = boxes_left + index * (LEGEND_BOX_SIZE + LEGEND_BOX_GAP)
+                color = "black" if value == 1 else "white"
+                canvas.create_rectangle(box_left, box_top, box_left + LEGEND_BOX_SIZE, box_top + LEGEND_BOX_SIZE,
+                                        fill=color, outline="black")
+                right = max(right, box_left + LEGEND_BOX_SIZE)
+
+        bottom = max(bottom, top + len(tokens) * LEGEND_ROW_HEIGHT)
+        left = right + LEGEND_COLUMN_GAP  # Move to the next column for the next section
+
+    canvas.config(width=left - LEGEND_COLUMN_GAP + LEGEND_PADDING, height=bottom + LEGEND_PADDING)
+    canvas.pack()
 
-                # Display the visual representation of the pattern
-                for value in pattern:
-                    color = "black" if value == 1 else "white"
-                    tk.Label(row_frame, bg=color, width=2, height=1, relief="solid").pack(side="left", padx=1)
 
-            column += 1  # Move to the next column for the next section
+def log_message(message, is_error=False):
+    """
+    Queues a message for the console box. Safe to call from the conversion thread,
+    the queue is drained in batches by drain_events on the Tk main thread.
+    """
+    event_queue.put(("log", message, is_error))
 
 
-def log_message(message, is_error=False):
+def write_log_batch(messages):
     """
-    Logs a message to the console box.
+    Appends a batch of (message, is_error) pairs to the console box in one go.
     """
     console_box.config(state="normal")  # Enable editing to append
-    console_box.insert(tk.END, message + "\n")
+    for message, is_error in messages:
+        console_box.insert(tk.END, message + "\n", ("error",) if is_error else ())
     console_box.see(tk.END)  # Auto-scroll to the latest log
-    if is_error:
-        console_box.tag_add("error", "end-2l", "end-1l")
-        console_box.tag_config("error", foreground="red")
     console_box.config(state="disabled")  # Disable editing to prevent user input
 
-def draw_visual_preview(data):
+
+def drain_events():
+    """
+    Handles the queued log, progress and completion events, then reschedules itself.
     """
-    Render the array of arrays as a visual preview with 0s and 1s.
+    messages = []
+    try:
+        for _ in range(MAX_EVENTS_PER_DRAIN):
+            event = event_queue.get_nowait()
+            if event[0] == "log":
+                messages.append(event[1:])
+            elif event[0] == "progress":
+                progress_bar.config(value=event[1])
+            elif event[0] == "done":
+                conversion_finished()
+    except queue.Empty:
+        pass
+    if messages:
+        write_log_batch(messages)
+    root.after(DRAIN_INTERVAL_MS, drain_events)
+
+def draw_visual_preview(document):
+    """
+    Render the document's sections as a visual preview with 0s and 1s.
     Includes zoom functionality with mouse scroll.
+    Only the visible part of the grid is rasterized into a single PhotoImage, so
+    scrolling, zooming and edits cost the same however large the art is.
+    Returns an update(first, removed, added) function to call after an edit.
     """
     preview_window = tk.Toplevel()
     preview_window.title("Visual Preview")
@@ -68,8 +134,13 @@ def draw_visual_preview(data):
     canvas_frame.pack(fill="both", expand=True)
 
     canvas = tk.Canvas(canvas_frame, bg="white")
-    h_scrollbar = tk.Scrollbar(canvas_frame, orient="horizontal", command=canvas.xview)
-    v_scrollbar = tk.Scrollbar(canvas_frame, orient="vertical", command=canvas.yview)
+
+    def scroll(view, *args):
+        view(*args)
+        schedule_render()
+
+    h_scrollbar = tk.Scrollbar(canvas_frame, orient="horizontal", command=lambda *args: scroll(canvas.xview, *args))
+    v_scrollbar = tk.Scrollbar(canvas_frame, orient="vertical", command=lambda *args: scroll(canvas.yview, *args))
     canvas.configure(xscrollcommand=h_scrollbar.set, yscrollcommand=v_scrollbar.set)
 
     # Pack canvas and scrollbars
@@ -80,47 +151,48 @@ def draw_visual_preview(data):
     canvas_frame.grid_rowconfigure(0, weight=1)
     canvas_frame.grid_columnconfigure(0, weight=1)
 
-    def redraw_canvas():
+    margin = 10
+    viewport_image = tk.PhotoImage()
+    image_item = canvas.create_image(margin, margin, image=viewport_image, anchor="nw")
+    render_pending = [False]
+
+    def render_viewport():
+        """
+        Rasterize the cells under the visible part of the canvas and move the image there.
         """
-        Redraw the canvas based on the current zoom factor.
+        render_pending[0] = False
+        box_size = max(int(20 * zoom_factor.get()), 2)  # Scale box size
+        column_total = len(document.sections) * row_count
+        cell_total = document.max_cells
+        canvas.config(scrollregion=(0, 0, 2 * margin + column_total * box_size, 2 * margin + cell_total * box_size))
+
+        first_column = max(int((canvas.canvasx(0) - margin) // box_size), 0)
+        first_cell = max(int((canvas.canvasy(0) - margin) // box_size), 0)
+        column_count = min(canvas.winfo_width() // box_size + 2, column_total - first_column)
+        cell_count = min(canvas.winfo_height() // box_size + 2, cell_total - first_cell)
+        if column_count <= 0 or cell_count <= 0:
+            canvas.itemconfig(image_item, state="hidden")
+            return
+
+        ppm = render_preview_ppm(document.masks, first_column, column_count, first_cell, cell_count, box_size)
+        viewport_image.configure(data=ppm, format="ppm")
+        canvas.coords(image_item, margin + first_column * box_size, margin + first_cell * box_size)
+        canvas.itemconfig(image_item, state="normal")
+
+    def schedule_render():
+        # Coalesce bursts of scroll, resize and edit events into one render
+        if not render_pending[0]:
+            render_pending[0] = True
+            canvas.after_idle(render_viewport)
+
+    def update(first, removed, added):
         """
-        canvas.delete("all")  # Clear previous drawing
-
-        box_size = int(20 * zoom_factor.get())  # Scale box size
-        x_start, y_start = 10, 10
-        y_offset = 0
-
-        for section in data:
-            x_offset = 0
-            # Rotate the visual representation (values flipped)
-            for value in section:
-                if value == 1:
-                    # Draw a filled black box for '1'
-                    canvas.create_rectangle(
-                        y_start + y_offset,
-                        x_start + x_offset,
-                        y_start + y_offset + box_size,
-                        x_start + x_offset + box_size,
-                        fill="black", outline="black", width=2
-                    )
-                elif value == 0:
-                    # Draw a hollow box for '0'
-                    canvas.create_rectangle(
-                        y_start + y_offset,
-                        x_start + x_offset,
-                        y_start + y_offset + box_size,
-                        x_start + x_offset + box_size,
-                        outline="black", width=2
-                    )
-                x_offset += box_size  # Adjust spacing between boxes
-            y_offset += box_size  # Adjust spacing for newlines
-
-        # Update the scroll region to fit the new content
-        canvas.update_idletasks()
-        canvas.config(scrollregion=canvas.bbox("all"))
+        Called after sections[first:first + removed] were replaced by `added` sections.
+        """
+        schedule_render()
 
     # Initial draw
-    redraw_canvas()
+    schedule_render()
 
     # Function to handle zooming with mouse scroll
     def on_zoom(event):
@@ -133,27 +205,120 @@ def draw_visual_preview(data):
         elif event.delta < 0:
             # Scroll down -> zoom out
             zoom_factor.set(max(zoom_factor.get() - 0.1, 0.5))  # Min zoom of 0.5x
-        redraw_canvas()
+        schedule_render()
 
-    # Bind Ctrl + Mouse Scroll to zoom
+    # Bind Ctrl + Mouse Scroll to zoom, re-render when the window is resized
     canvas.bind("<Control-MouseWheel>", on_zoom)
+    canvas.bind("<Configure>", lambda event: schedule_render())
+
+    def on_close():
+        global live_preview_update
+        if live_preview_update is update:
+            live_preview_update = None
+        preview_window.destroy()
+
+    preview_window.protocol("WM_DELETE_WINDOW", on_close)
+    return update
 
 
+def on_input_edit(action, index, changed_text):
+    """
+    Validate command of the input field: applies every insert/delete to the live
+    document and updates the open preview with just the changed sections.
+    """
+    index = int(index)
+    if action == "1":
+        changed = live_document.apply_edit(index, index, changed_text)
+    elif action == "0":
+        changed = live_document.apply_edit(index, index + len(changed_text), "")
+    else:
+        return True
+    if live_preview_update is not None:
+        live_preview_update(*changed)
+    return True
+
 
 def preview_midi_conversion():
+    global live_preview_update
     input_text = input_field.get()
 
     if not input_text:
         log_message("Error: Input field cannot be empty.", is_error=True)
         return
 
+    if has_run_syntax(input_text):
+        # Repeats are previewed written out, in a window that does not follow the input
+        try:
+            document = IncrementalDocument(expand_runs(input_text))
+            document.check()
+        except Exception as e:
+            log_message(str(e), is_error=True)
+            return
+        draw_visual_preview(document)
+        return
+
+    if len(live_document) != len(input_text):
+        # The field was changed without going through the validate command
+        live_document.set_text(input_text)
+
     try:
-        visual_data = text_to_array(input_text, logger=log_message)
-        draw_visual_preview(visual_data)
+        live_document.check()
     except Exception as e:
         log_message(str(e), is_error=True)
+        return
+
+    # One preview window is kept open and follows the input as it is edited
+    if live_preview_update is None:
+        live_preview_update = draw_visual_preview(live_document)
+
+
+def conversion_worker(input_text, file_name, cancel_event):
+    """
+    Runs on the conversion thread and only talks to the GUI through event_queue.
+    """
+    try:
+        key = conversion_cache.key("midi", input_text)
+        contents = conversion_cache.get(key)
+        if contents is None and has_run_syntax(input_text):
+            # Run-length input is compiled without expanding it, which needs no progress
+            contents = run_text_to_midi(input_text)
+            conversion_cache.put(key, contents)
+        elif contents is None:
+            output = io.BytesIO()
+            stream_text_to_midi(
+                io.StringIO(input_text), output, chunk_size=PROGRESS_CHUNK_SIZE, logger=log_message,
+                progress=lambda tokens: event_queue.put(("progress", tokens)), cancel=cancel_event
+            )
+            contents = output.getvalue()
+            conversion_cache.put(key, contents)
+        with open(file_name, "wb") as f:
+            f.write(contents)
+        log_message(f"MIDI file generated successfully as '{file_name}'.")
+    except ConversionCancelled as e:
+        log_message(str(e), is_error=True)
+    except ValueError as ve:
+        log_message(str(ve), is_error=True)
+    except Exception as e:
+        log_message(f"An unexpected error occurred: {e}", is_error=True)
+    finally:
+        event_queue.put(("done",))
+
+
+def conversion_finished():
+    global cancel_event
+    cancel_event = None
+    progress_bar.config(value=progress_bar.cget("maximum"))
+    submit_button.config(state="normal")
+    cancel_button.config(state="disabled")
+
+
+def cancel_conversion():
+    if cancel_event is not None:
+        cancel_event.set()
+
 
 def run_midi_conversion():
+    global cancel_event
     input_text = input_field.get()
     file_name = file_name_field.get().strip()
 
@@ -168,11 +333,12 @@ def run_midi_conversion():
     if not file_name.endswith(".mid"):
         file_name += ".mid"
 
-    try:
-        # Pass the log_message function as the logger to text_to_midi2
-        text_to_midi2(input_text, output_file=file_name, logger=log_message)
-    except Exception as e:
-        log_message(f"An unexpected error occurred: {e}", is_error=True)
+    # The conversion runs on a worker thread, the GUI follows it through event_queue
+    cancel_event = threading.Event()
+    progress_bar.config(maximum=max(len(input_text) // 2, 1), value=0)
+    submit_button.config(state="disabled")
+    cancel_button.config(state="normal")
+    threading.Thread(target=conversion_worker, args=(input_text, file_name, cancel_event), daemon=True).start()
 
 
 # Main Tkinter setup
@@ -194,6 +360,7 @@ console_box.pack(side="left", fill="both", expand=True)
 scrollbar = tk.Scrollbar(console_frame, command=console_box.yview)
 scrollbar.pack(side="right", fill="y")
 console_box.config(yscrollcommand=scrollbar.set)
+console_box.tag_config("error", foreground="red")
 
 # Bottom frame for input fields and button
 input_frame = tk.Frame(root)
@@ -203,6 +370,7 @@ input_frame.grid(row=2, column=0, columnspan=2, pady=10)
 tk.Label(input_frame, text="Enter your input string:").grid(row=0, column=0, padx=5, sticky="e")
 input_field = tk.Entry(input_frame, width=50)
 input_field.grid(row=0, column=1, padx=5)
+input_field.config(validate="key", validatecommand=(root.register(on_input_edit), "%d", "%i", "%S"))
 
 # Input for the file name
 tk.Label(input_frame, text="Enter file name:").grid(row=1, column=0, padx=5, sticky="e")
@@ -221,5 +389,16 @@ preview_button.pack(side="left", padx=5)
 submit_button = tk.Button(button_frame, text="Convert to MIDI", command=run_midi_conversion)
 submit_button.pack(side="left", padx=5)
 
+# Cancel button, only enabled while a conversion is running
+cancel_button = tk.Button(button_frame, text="Cancel", command=cancel_conversion, state="disabled")
+cancel_button.pack(side="left", padx=5)
+
+# Progress of the running conversion in tokens
+progress_bar = ttk.Progressbar(input_frame, orient="horizontal", length=400, mode="determinate")
+progress_bar.grid(row=3, column=0, columnspan=2, pady=5)
+
+# Start handling queued log and progress events
+root.after(DRAIN_INTERVAL_MS, drain_events)
+
 # Run the Tkinter loop
 root.mainloop()
\ No newline at end of file
@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from http import HTTPStatus
+
+import logic
+from logic import ConversionCache, PipelineStats, RunLimitError, cached_midi, text_to_array
+
+# Local conversion service, run with:
+#   python service.py --port 8765          (or --unix /tmp/converter.sock)
+# Endpoints:
+#   POST /midi     body: the input text (or JSON {"text": ...}), returns audio/midi bytes
+#   POST /array    same body, returns the text_to_array grid as JSON
+#   GET  /metrics  request counts, latency percentiles and queue depth as JSON
+#   GET  /health
+# Conversions run in a process pool. At most max_concurrency of them run at once and at
+# most max_queue more may wait for a slot, further requests get 503 straight away.
+# Run-length input may expand to at most max_expanded_tokens tokens (by default as many
+# as the largest plain body holds), larger expansions get 413 like oversized bodies.
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_QUEUE = 64
+DEFAULT_MAX_BODY = 64 << 20
+HEADER_TIMEOUT = 30  # seconds a client gets to send the request line, headers and body
+LATENCY_WINDOW = 1024  # latencies kept for the percentiles in /metrics
+
+worker_cache = None  # ConversionCache of this worker process
+
+
+def init_worker(cache_dir=None, max_expanded_tokens=None):
+    global worker_cache
+    worker_cache = ConversionCache(directory=cache_dir)
+    if max_expanded_tokens is not None:
+        logic.max_expanded_tokens = max_expanded_tokens
+
+
+def convert_midi(text):
+    """
+    Runs in a worker process and returns the MIDI file contents for text.
+    """
+    return cached_midi(text, worker_cache, PipelineStats())
+
+
+def convert_array(text):
+    """
+    Runs in a worker process and returns the text_to_array grid for text.
+    """
+    return text_to_array(text, cache=worker_cache)
+
+
+class RequestError(Exception):
+    """
+    Ends a request with the given HTTP status and message.
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ServiceMetrics:
+    """
+    Request counters, latencies and queue depth of a ConversionService.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.requests = {}  # "METHOD path status" -> count
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.latency_total = 0.0
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.rejected = 0
+
+    def record(self, method, path, status, elapsed):
+        key = f"{method} {path} {status}"
+        self.requests[key] = self.requests.get(key, 0) + 1
+        self.latencies.append(elapsed)
+        self.latency_total += elapsed
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def as_dict(self):
+        count = sum(self.requests.values())
+        return {
+            'uptime seconds': time.time() - self.started,
+            'requests': dict(self.requests),
+            'request count': count,
+            'mean latency seconds': self.latency_total / count if count else None,
+            'p50 latency seconds': self.percentile(0.5),
+            'p95 latency seconds': self.percentile(0.95),
+            'p99 latency seconds': self.percentile(0.99),
+            'in flight': self.in_flight,
+            'queue depth': self.queue_depth,
+            'max queue depth': self.max_queue_depth,
+            'rejected': self.rejected,
+        }
+
+
+class ConversionService:
+    """
+    Minimal HTTP/1.1 server (one request per connection) that hands conversions to a
+    process pool. Listens on host:port or on a Unix socket path.
+    """
+    def __init__(self, workers=None, max_concurrency=None, max_queue=DEFAULT_MAX_QUEUE,
+                 max_body=DEFAULT_MAX_BODY, cache_dir=None, max_expanded_tokens=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_concurrency = max_concurrency or self.workers
+        self.max_queue = max_queue
+        self.max_body = max_body
+        self.cache_dir = cache_dir
+        # Every plain token is 2 bytes, so this keeps expanded input within max_body
+        self.max_expanded_tokens = max_body // 2 if max_expanded_tokens is None else max_expanded_tokens
+        self.metrics = ServiceMetrics()
+        self.executor = None
+        self.server = None
+        self.slots = None
+        self.connections = set()
+        self.closing = False
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT, unix_path=None):
+        self.slots = asyncio.Semaphore(self.max_concurrency)
+        # Forked workers would inherit the sockets of open connections and keep them
+        # from closing, so start them from a clean forkserver process where available
+        context = None
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=init_worker,
+                                            initargs=(self.cache_dir, self.max_expanded_tokens))
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, unix_path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    def addresses(self):
+        return [sock.getsockname() for sock in self.server.sockets]
+
+    async def shutdown(self, timeout=30):
+        """
+        Stops accepting connections, waits up to timeout seconds for the requests in
+        progress to finish and then stops the worker processes.
+        """
+        self.closing = True
+        self.server.close()
+        # Since Python 3.12.1 wait_closed also waits for the open connections, so they get
+        # the timeout first and whatever is left is cancelled
+        finished = True
+        if self.connections:
+            _, pending = await asyncio.wait(self.connections, timeout=timeout)
+            finished = not pending
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self.server.wait_closed()
+        # Joining the workers blocks, so it runs off the event loop. After a timeout the
+        # conversions still running are not waited for.
+        shutdown = functools.partial(self.executor.shutdown, wait=finished, cancel_futures=True)
+        await asyncio.get_running_loop().run_in_executor(None, shutdown)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        start = time.perf_counter()
+        method = path = '-'
+        try:
+            try:
+                method, path, headers, body = await asyncio.wait_for(self.read_request(reader), HEADER_TIMEOUT)
+                status, content_type, payload = await self.dispatch(method, path, headers, body)
+            except RequestError as e:
+                status, content_type, payload = e.status, 'application/json', self.error_body(str(e))
+            except asyncio.TimeoutError:
+                status, content_type, payload = (HTTPStatus.REQUEST_TIMEOUT, 'application/json',
+                                                 self.error_body("Request timed out."))
+            except asyncio.CancelledError:
+                # Cancelled by shutdown once its timeout ran out
+                status, content_type, payload = (HTTPStatus.SERVICE_UNAVAILABLE, 'application/json',
+                                                 self.error_body("The service shut down before the request finished."))
+            await self.write_response(writer, status, content_type, payload)
+            self.metrics.record(method, path, int(status), time.perf_counter() - start)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self.connections.discard(task)
+
+    async def read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Malformed request line.")
+        method, target, _ = request_line
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length.")
+        if length > self.max_body:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Body larger than {self.max_body} bytes.")
+        body = await reader.readexactly(length) if length else b''
+        return method, target.split('?', 1)[0], headers, body
+
+    async def dispatch(self, method, path, headers, body):
+        if path == '/health' and method == 'GET':
+            return HTTPStatus.OK, 'application/json', json.dumps({'status': 'ok'}).encode()
+        if path == '/metrics' and method == 'GET':
+            return HTTPStatus.OK, 'application/json', json.dumps(self.metrics.as_dict(), indent=2).encode()
+        if path in ('/midi', '/array'):
+            if method != 'POST':
+                raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED, f"Use POST for {path}.")
+            text = self.request_text(headers, body)
+            if path == '/midi':
+                return HTTPStatus.OK, 'audio/midi', await self.convert(convert_midi, text)
+            rows = await self.convert(convert_array, text)
+            return HTTPStatus.OK, 'application/json', json.dumps(rows, separators=(',', ':')).encode()
+        raise RequestError(HTTPStatus.NOT_FOUND, f"No such endpoint: {path}")
+
+    @staticmethod
+    def request_text(headers, body):
+        try:
+            if headers.get('content-type', '').startswith('application/json'):
+                text = json.loads(body)['text']
+                if not isinstance(text, str):
+                    raise TypeError
+            else:
+                text = body.decode('ascii')
+        except (ValueError, KeyError, TypeError):
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               "Send the input as ASCII text or as JSON with a 'text' string.")
+        return text.strip()
+
+    async def convert(self, function, text):
+        """
+        Runs function(text) in the process pool once a slot is free.
+        """
+        metrics = self.metrics
+        if self.closing:
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "The service is shutting down.")
+        if self.slots.locked() and metrics.queue_depth >= self.max_queue:
+            metrics.rejected += 1
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many requests in the queue, try again later.")
+        metrics.queue_depth += 1
+        metrics.max_queue_depth = max(metrics.max_queue_depth, metrics.queue_depth)
+        try:
+            await self.slots.acquire()
+        finally:
+            metrics.queue_depth -= 1
+        metrics.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, text)
+        except RunLimitError as e:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, str(e))
+        except ValueError as ve:
+            raise RequestError(HTTPStatus.UNPROCESSABLE_ENTITY, str(ve))
+        except Exception as e:
+            raise RequestError(HTTPStatus.INTERNAL_SERVER_ERROR, f"An unexpected error occurred: {e}")
+        finally:
+            metrics.in_flight -= 1
+            self.slots.release()
+
+    @staticmethod
+    def error_body(message):
+        return json.dumps({'error': message}).encode()
+
+    @staticmethod
+    async def write_response(writer, status, content_type, payload):
+        status = HTTPStatus(status)
+        head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: close\r\n\r\n")
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
+
+
+async def serve(host='127.0.0.1', port=DEFAULT_PORT, unix_path=None, shutdown_timeout=30, **options):
+    """
+    Runs a ConversionService until SIGINT or SIGTERM, then shuts it down gracefully.
+    """
+    service = ConversionService(**options)
+    await service.start(host, port, unix_path)
+    print(f"Serving on {unix_path or ', '.join(f'{address[0]}:{address[1]}' for address in service.addresses())}")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop.set)
+        except (NotImplementedError, RuntimeError):  # Windows, or not the main thread
+            pass
+    try:
+        await stop.wait()
+    finally:
+        print("Shutting down, waiting for requests in progress...")
+        await service.shutdown(shutdown_timeout)
+        if unix_path is not None:
+            with suppress(OSError):
+                os.remove(unix_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python service.py', description="Local text to MIDI conversion service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', default=None, help="listen on this Unix socket path instead of host:port")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--max-concurrency', type=int, default=None,
+                        help="conversions running at once (default: workers)")
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help="conversions waiting for a slot before new ones get 503")
+    parser.add_argument('--max-body', type=int, default=DEFAULT_MAX_BODY, help="largest accepted body in bytes")
+    parser.add_argument('--cache-dir', default=None, help="directory of cached conversions shared between runs")
+    parser.add_argument('--max-expanded-tokens', type=int, default=None,
+                        help="tokens run-length input may expand to (default: max body / 2)")
+    parser.add_argument('--shutdown-timeout', type=float, default=30,
+                        help="seconds to wait for requests in progress on shutdown")
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.host, args.port, args.unix, args.shutdown_timeout, workers=args.workers,
+                      max_concurrency=args.max_concurrency, max_queue=args.max_queue, max_body=args.max_body,
+                      cache_dir=args.cache_dir, max_expanded_tokens=args.max_expanded_tokens))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
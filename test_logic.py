@@ -0,0 +1,321 @@
+import base64
+import random
+import struct
+import zlib
+
+import pytest
+
+import logic
+from logic import convert_text_to_midi, image_to_text, load_image, read_pnm, row_count, text_to_array
+
+YINYANG = ("0a9c9d4e4e0f0f0f0f0f0e6d6d9d9c0a9p0f0f0f5d5d0f0f0f0e0a0a9c9c0a0c0f9p0b0d0e2d2d0c0b0a0a0a0a4b9c7c4c0b9p"
+           "0a0a0a0a0a0b0b0b0b0b0b0a0a0a0a0a")
+SANS = ("0a0a0a4b3b2b1b1b0b0b0b3c5d5d5d6c1b2b2b1b1b6c1b2b2b3b4b0a0a0a9p0a9d0c0a0a0a0a0a0a0a4e0f0f0d0d0f4e0a9c1b4c2e5c"
+        "7c9c0a0a0c9d0a9p0f0a0a0a0a0a0a0a0a0a0c0d0d0d0d0c0c3c4b4b0a0a0f2b2b0d9d0a0a0f9p0f0a0a0a0a0a0a0a0a0a0a4b4b4b4b"
+        "0c0c0d0d0d0a0a0f3c3c3c0f0a0a0f9p0c9d0a0a0a0a0a0a0a0a0f0f0f2d2d0f0f1b7c0a0a9c1e8c7c4c0b0a9d0c9p0a0a0c2b3b4b0a"
+        "0a0a0a0b0d0e0e0e0d0b4b4b0b0c0d0b4b4b3b2b0c0a0a9p0a0a0a0a0a0a0b0b1b1b1b1b1b1b1b0b0b0a0a0b0b0b0b0a0a0a0a0a0a0a")
+
+# MIDI files the original process_parse_tree wrote for YINYANG and SANS, zlib compressed
+GOLDEN_MIDI = {
+    'yinyang': ('eNqNkzkOwjAURJ+FxHWowr4MgTZUOUIKJDpOwBF8RG4SLMWIRMZL6z/z9OWZ37T3DphjMObdtM8HzG7YkziK'
+                'g9iLndiqewVP2LOQCAcbsXaO5Bhbi7Ri5RgFIuxFlOiWjlcsTVLzMM+4ipjIjSvHyClGjJS71Bc1Velth5/J'
+                'LPwVxUl5TIYRtVZhYn8i+uU6idCnVY9r57s1WCeN9v0tupF+wQdrG6DW'),
+    'sans': ('eNqtlUtywjAQRNubHCcEgjEQPg0kgZBixxFYpCo7TsARdMScJDAlG5VkeyycsJS69TSjkUa7/dcBwAMSJMnPbn/'
+             '8lsEvzIpYEguCxJyYEVMeTnWzMG/EKzEhXoghkREDIhW7IsC8E2NiRPSJZzGGY5i1h++JHo5hNmEEEwvuilERYD'
+             '7qhCdZoQh2xaKilRIpADf4YLaKL7NZd4QUc4SMXBtdt8hProxRTDopwihWfyqRju0uUqFHYdxg0klxTMDwZZdnz'
+             '5a+YDQ6LCP17amv5HdzWLJUZq3X5ei0mmBiJoXUBPhbtHrO9zhRrW7daGUjjPb3rPZC+1Grtz40/fflaG/cvc+m'
+             'RuCZ7t+fqo0wa2iSmeuT7XtxrLvHfof2/02L3+zcwQVP50h4'),
+}
+PATTERN_TOKENS = [token for token in logic.token_names if token != '9p']
+
+
+def random_text(rng):
+    sections = []
+    for _ in range(rng.randint(1, 8)):
+        length = rng.randint(1, 123)
+        sections.append(''.join(rng.choice(PATTERN_TOKENS) for _ in range(length)))
+    return '9p'.join(sections)
+
+
+def convert(text, backend, tmp_path):
+    path = tmp_path / f"{backend}.mid"
+    convert_text_to_midi(text, str(path), backend=backend)
+    return path.read_bytes()
+
+
+def midi_bytes(text):
+    grid = logic.Grid.from_token_ids(logic.tokenize_ids(text))
+    return logic.write_midi(*logic.build_events(grid.masks, grid.section_starts)[:3])
+
+
+@pytest.mark.parametrize('text', [YINYANG, SANS, '0a', '1b9p0a9p2c'], ids=['yinyang', 'sans', 'silent', 'short'])
+def test_native_backend_matches_mido(text, tmp_path):
+    pytest.importorskip('mido')
+    assert convert(text, 'native', tmp_path) == convert(text, 'mido', tmp_path)
+
+
+def test_native_backend_matches_mido_on_random_inputs(tmp_path):
+    pytest.importorskip('mido')
+    rng = random.Random(7)
+    for _ in range(50):
+        text = random_text(rng)
+        assert convert(text, 'native', tmp_path) == convert(text, 'mido', tmp_path), text
+
+
+def test_parallel_conversion_matches_serial(tmp_path):
+    rng = random.Random(5)
+    for _ in range(8):
+        text = random_text(rng)
+        assert logic.parallel_text_to_midi(text, workers=2, chunk_tokens=8) == convert(text, 'native', tmp_path), text
+
+
+@pytest.mark.parametrize('tail', ['9p9p3d9p3d', '9p3d9p'], ids=['empty section', 'trailing separator'])
+def test_parallel_conversion_reports_serial_parse_error(tmp_path, tail):
+    text = '9p'.join(['0a1b2c'] * 8) + tail
+    with pytest.raises(logic.ParseError) as serial:
+        convert(text, 'native', tmp_path)
+    with pytest.raises(logic.ParseError) as parallel:
+        logic.parallel_text_to_midi(text, workers=2, chunk_tokens=4)
+    assert parallel.value.offset == serial.value.offset and str(parallel.value) == str(serial.value)
+
+
+@pytest.fixture(params=['numpy', 'pure'])
+def numpy_mode(request, monkeypatch):
+    """
+    Runs a test with NumPy and again with the pure Python fallbacks.
+    """
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setitem(logic.optional_modules, 'numpy', None)
+    return request.param
+
+
+@pytest.mark.parametrize('name, text', [('yinyang', YINYANG), ('sans', SANS)])
+def test_golden_midi(numpy_mode, name, text):
+    assert midi_bytes(text) == zlib.decompress(base64.b64decode(GOLDEN_MIDI[name]))
+
+
+def test_build_events_matches_pure_python(numpy_mode):
+    rng = random.Random(13)
+    texts = [YINYANG, SANS, '0a9p0a0a9p1b', '0f'] + [random_text(rng) for _ in range(30)]
+    for text in texts:
+        grid = logic.Grid.from_token_ids(logic.tokenize_ids(text))
+        total_skips = rng.randint(0, 3)
+        statuses, notes, times = [], [], []
+        skips = total_skips
+        for section in grid.sections():
+            skips = logic.build_section_events(section, skips, statuses, notes, times)
+        assert logic.build_events(grid.masks, grid.section_starts, total_skips) == (statuses, notes, times, skips)
+
+
+def random_bitmap(rng, height, width):
+    return [[rng.randint(0, 1) for _ in range(width)] for _ in range(height)]
+
+
+def padded(bitmap):
+    # The encoder adds blank rows up to a multiple of row_count
+    return bitmap + [[0] * len(bitmap[0]) for _ in range(-len(bitmap) % row_count)]
+
+
+@pytest.mark.parametrize('height, width', [(5, 1), (7, 3), (10, 40), (13, 17)])
+def test_image_round_trip(numpy_mode, height, width):
+    bitmap = random_bitmap(random.Random(height * width), height, width)
+    assert text_to_array(image_to_text(bitmap)) == padded(bitmap)
+
+
+def encode_pnm(magic, bitmap):
+    height, width = len(bitmap), len(bitmap[0])
+    if magic == 'P1':
+        return b'P1\n# comment\n%d %d\n' % (width, height) + b'\n'.join(
+            b' '.join(b'%d' % value for value in row) for row in bitmap)
+    if magic == 'P4':
+        rows = []
+        for row in bitmap:
+            row = row + [0] * (-width % 8)
+            rows.append(bytes(int(''.join(map(str, row[i:i + 8])), 2) for i in range(0, len(row), 8)))
+        return b'P4 %d %d\n' % (width, height) + b''.join(rows)
+    # Gray images: dark pixels are ink
+    samples = [0 if value else 255 for row in bitmap for value in row]
+    if magic == 'P2':
+        return b'P2\n%d %d\n255\n' % (width, height) + b' '.join(b'%d' % sample for sample in samples)
+    return b'P5 %d %d 255\n' % (width, height) + bytes(samples)
+
+
+@pytest.mark.parametrize('magic', ['P1', 'P2', 'P4', 'P5'])
+@pytest.mark.parametrize('height, width', [(5, 8), (9, 13)])
+def test_pnm_round_trip(numpy_mode, tmp_path, magic, height, width):
+    bitmap = random_bitmap(random.Random(width), height, width)
+    data = encode_pnm(magic, bitmap)
+    path = tmp_path / ('image.pbm' if magic in ('P1', 'P4') else 'image.pgm')
+    path.write_bytes(data)
+    assert [list(map(int, row)) for row in read_pnm(data)] == bitmap
+    assert text_to_array(image_to_text(load_image(str(path)))) == padded(bitmap)
+
+
+def png_filter(kind, row, previous, pixel_size):
+    # Inverse of the decoder's unfilter, the Paeth predictor as in the PNG specification
+    out = bytearray([kind])
+    for i, value in enumerate(row):
+        left = row[i - pixel_size] if i >= pixel_size else 0
+        upper_left = previous[i - pixel_size] if i >= pixel_size else 0
+        estimate = left + previous[i] - upper_left
+        paeth = min((abs(estimate - left), 0, left), (abs(estimate - previous[i]), 1, previous[i]),
+                    (abs(estimate - upper_left), 2, upper_left))[2]
+        predictor = [0, left, previous[i], (left + previous[i]) // 2, paeth][kind]
+        out.append((value - predictor) & 0xff)
+    return out
+
+
+def encode_png(bitmap, depth, alpha):
+    height, width = len(bitmap), len(bitmap[0])
+    maxval = (1 << depth) - 1
+    sample_bytes = max(depth // 8, 1)
+    rows = []
+    for row in bitmap:
+        samples = [0 if value else maxval for value in row]
+        if alpha:
+            samples = [value for sample in samples for value in (sample, maxval)]
+        if depth < 8:
+            bits = ''.join(format(sample, f'0{depth}b') for sample in samples)
+            bits += '0' * (-len(bits) % 8)
+            rows.append(int(bits, 2).to_bytes(len(bits) // 8, 'big'))
+        else:
+            rows.append(b''.join(sample.to_bytes(sample_bytes, 'big') for sample in samples))
+    pixel_size = sample_bytes * (2 if alpha else 1)
+    previous = bytes(len(rows[0]))
+    filtered = b''
+    for index, row in enumerate(rows):
+        filtered += png_filter(index % 5, row, previous, pixel_size)
+        previous = row
+
+    def chunk(kind, data):
+        return struct.pack('>L', len(data)) + kind + data + struct.pack('>L', zlib.crc32(kind + data))
+    header = struct.pack('>LLBBBBB', width, height, depth, 4 if alpha else 0, 0, 0, 0)
+    return (logic.PNG_SIGNATURE + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(filtered))
+            + chunk(b'IEND', b''))
+
+
+@pytest.mark.parametrize('depth, alpha', [(1, False), (2, False), (4, False), (8, False), (16, False),
+                                          (8, True), (16, True)])
+def test_png_round_trip(numpy_mode, monkeypatch, tmp_path, depth, alpha):
+    monkeypatch.setitem(logic.optional_modules, 'PIL.Image', None)
+    bitmap = random_bitmap(random.Random(depth), 11, 13)
+    path = tmp_path / 'image.png'
+    path.write_bytes(encode_png(bitmap, depth, alpha))
+    assert [list(map(int, row)) for row in load_image(str(path))] == bitmap
+
+
+def test_run_expansion_is_limited(monkeypatch):
+    text = '(0a{1000}9p){300}0b'
+    assert len(logic.expand_runs(text)) == 2 * (300 * 1001 + 1)
+    monkeypatch.setattr(logic, 'max_expanded_tokens', 1000)
+    with pytest.raises(logic.RunLimitError):
+        text_to_array(text)
+    with pytest.raises(logic.RunLimitError):
+        logic.expand_runs('0a{1001}')
+    monkeypatch.setattr(logic, 'max_run_midi_bytes', 1 << 16)
+    with pytest.raises(logic.RunLimitError):
+        logic.run_text_to_midi('(1b9p){100000}0a')
+
+
+def test_cache_directory_is_bounded(tmp_path):
+    cache = logic.ConversionCache(max_entries=10, max_bytes=1000, directory=str(tmp_path))
+    for index in range(50):
+        cache.put(cache.key('test', str(index)), bytes(50))
+    files = list(tmp_path.iterdir())
+    assert len(files) <= 10 and sum(path.stat().st_size for path in files) <= 1000
+    assert cache.stats()['disk entries'] == len(files)
+    # A new cache over the same directory finds its files
+    assert logic.ConversionCache(directory=str(tmp_path)).get(cache.key('test', '49')) == bytes(50)
+
+
+def test_incremental_document_matches_full_lex():
+    rng = random.Random(11)
+    pieces = ['0a', '9p', '1b', '9', 'p', 'x', '2c3d']
+    text = ''.join(rng.choice(pieces) for _ in range(40))
+    document = logic.IncrementalDocument(text)
+    for _ in range(300):
+        start = rng.randint(0, len(text))
+        end = rng.randint(start, min(start + 6, len(text)))
+        replacement = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 2)))
+        document.apply_edit(start, end, replacement)
+        text = text[:start] + replacement + text[end:]
+        fresh = logic.IncrementalDocument(text)
+        assert document.text == text and len(document) == len(text)
+        assert document.masks == fresh.masks and document.max_cells == fresh.max_cells
+        assert [document.offsets.prefix(index) for index in range(len(document.sections))] == fresh.section_starts()
+
+
+def test_incremental_document_refuses_run_syntax():
+    with pytest.raises(ValueError, match='Repeat syntax'):
+        logic.IncrementalDocument('0b{3}9p0a').check()
+    with pytest.raises(logic.TokenizeError, match='unclosed'):
+        logic.IncrementalDocument('(0b{3}9p0a').check()
+    logic.IncrementalDocument(logic.expand_runs('0b{3}9p0a')).check()
+
+
+def test_decoder_round_trip(tmp_path):
+    rng = random.Random(9)
+    for _ in range(30):
+        text = random_text(rng)
+        path = tmp_path / 'round_trip.mid'
+        convert_text_to_midi(text, str(path))
+        assert logic.verify_midi(str(path))[1], text
+
+
+def with_track_length(data, length):
+    # Rewrites the MTrk length so the decoder reads up to the cut instead of stopping at the header check
+    return data[:18] + length.to_bytes(4, 'big') + data[22:]
+
+
+def test_decoder_rejects_truncated_files():
+    data = midi_bytes('0a9p0a9p1b2c9p0a' * 40)
+    # The track starts with a two byte delta time and a note on, and ends with end of track
+    assert data[22:25] == bytes([0x87, 0x68, logic.NOTE_ON]) and data[-3:] == b'\xff\x2f\x00'
+    for cut in range(len(data)):
+        with pytest.raises(ValueError):
+            logic.midi_to_text(data[:cut])
+    # Cuts inside the delta time, the note on and the end of track meta event
+    for cut in (23, 25, 26, len(data) - 2, len(data) - 1):
+        with pytest.raises(ValueError, match='Truncated'):
+            logic.midi_to_text(with_track_length(data[:cut], cut - 22))
+
+
+def test_decoder_rejects_garbage():
+    rng = random.Random(3)
+    header = midi_bytes('0a')[:22]
+    for _ in range(200):
+        garbage = bytes(rng.randrange(256) for _ in range(rng.randint(0, 40)))
+        for data in (garbage, b'MThd' + garbage, with_track_length(header, len(garbage)) + garbage):
+            try:
+                logic.midi_to_text(data)
+            except ValueError:
+                pass
+
+
+def test_unpersisted_keys_skip_the_directory(tmp_path):
+    cache = logic.ConversionCache(directory=str(tmp_path))
+    key = cache.key('section', b'\x01')
+    (tmp_path / key).write_bytes(b'on disk')
+    assert cache.get(key, persist=False) is None
+    cache.put(key, b'in memory', persist=False)
+    assert cache.get(key, persist=False) == b'in memory'
+    assert cache.get(key) == b'in memory' and list(tmp_path.iterdir()) == [tmp_path / key]
+
+
+def test_batch_outputs_do_not_overwrite_each_other(tmp_path):
+    source = tmp_path / 'inputs.jsonl'
+    names = ['song', 'song', 'Song', 'so/ng', 'so?ng', 'song-2']
+    source.write_text(''.join(f'{{"name": "{name}", "text": "{index % 5}b"}}\n' for index, name in enumerate(names)))
+    summary = logic.run_batch(str(source), str(tmp_path / 'out'), workers=1)
+    outputs = [item['output'] for item in summary['items']]
+    assert summary['converted'] == len(names) and len({output.lower() for output in outputs}) == len(names)
+    assert len(list((tmp_path / 'out').iterdir())) == len(names)
+
+
+def test_batch_rejects_zero_workers(tmp_path):
+    with pytest.raises(SystemExit):
+        logic.main(['batch', str(tmp_path), '-w', '0'])
+    with pytest.raises(ValueError):
+        logic.run_batch(str(tmp_path), str(tmp_path / 'out'), workers=0)
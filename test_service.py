@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+from service import ConversionService
+from test_logic import YINYANG, midi_bytes
+
+# A conversion that keeps the single worker busy for a while
+SLOW_BODY = ('0a0b1b9p' * 600000 + '0a').encode()
+
+
+async def request(address, method, path, body=b'', content_type='text/plain'):
+    reader, writer = await asyncio.open_connection(*address)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    head, _, payload = data.partition(b'\r\n\r\n')
+    return int(head.split()[1]), payload
+
+
+async def wait_until(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def run_service(test, **options):
+    """
+    Runs test(service, address) against a ConversionService with one worker on a free port.
+    """
+    async def run():
+        service = ConversionService(workers=1, **options)
+        await service.start('127.0.0.1', 0)
+        try:
+            await test(service, service.addresses()[0][:2])
+        finally:
+            if not service.closing:
+                await service.shutdown(5)
+    asyncio.run(run())
+
+
+def test_conversion_endpoints():
+    async def test(service, address):
+        assert await request(address, 'POST', '/midi', YINYANG.encode()) == (200, midi_bytes(YINYANG))
+        status, _ = await request(address, 'POST', '/midi', b'0a9p')
+        assert status == 422
+        status, _ = await request(address, 'POST', '/array', b'0a' * 1000)
+        assert status == 413
+    run_service(test, max_body=1000)
+
+
+def test_full_queue_is_rejected():
+    async def test(service, address):
+        slow = asyncio.ensure_future(request(address, 'POST', '/midi', SLOW_BODY))
+        await wait_until(lambda: service.metrics.in_flight == 1)
+        queued = asyncio.ensure_future(request(address, 'POST', '/midi', b'0a'))
+        await wait_until(lambda: service.metrics.queue_depth == 1)
+        status, _ = await request(address, 'POST', '/midi', b'1b')
+        assert status == 503 and service.metrics.rejected == 1
+        assert [status for status, _ in await asyncio.gather(slow, queued)] == [200, 200]
+    run_service(test, max_queue=1)
+
+
+def test_shutdown_returns_within_timeout():
+    async def test(service, address):
+        slow = asyncio.ensure_future(request(address, 'POST', '/midi', SLOW_BODY))
+        await wait_until(lambda: service.metrics.in_flight == 1)
+        start = time.perf_counter()
+        await service.shutdown(0.2)
+        assert time.perf_counter() - start < 1
+        assert (await slow)[0] == 503
+    run_service(test)
+
+
+if __name__ == '__main__':
+    # The worker processes come from a forkserver, which imports this module again
+    raise SystemExit(pytest.main([__file__]))